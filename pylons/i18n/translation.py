@@ -4,6 +4,7 @@ Provides `_get_translator(lang)` which returns an object with gettext-like
 methods. If Babel is available it will use Babel translations; otherwise it
 falls back to a no-op translator.
 """
+import functools
 import gettext as gettext_module
 import os
 
@@ -47,11 +48,15 @@ class _NoopTranslator:
         return singular if n == 1 else plural
 
 
+@functools.lru_cache(maxsize=64)
 def _get_translator(lang=None):
     """Return a translator object for the given language.
 
     This intentionally returns a minimal translator that supports the calls
     tests and the codebase make (gettext / ugettext / ngettext).
+
+    Translators are cached per language so the catalogs are only loaded
+    once; callers share the returned object and must not modify it.
     """
     if BabelTranslations is None:
         return _NoopTranslator()
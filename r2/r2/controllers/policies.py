@@ -20,7 +20,7 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
-from BeautifulSoup import BeautifulSoup, Tag
+import lxml.html
 from pylons import app_globals as g
 from pylons import tmpl_context as c
 from pylons.i18n import _
@@ -28,7 +28,12 @@ from pylons.i18n import _
 from r2.controllers.reddit_base import RedditController
 from r2.lib.base import abort
 from r2.lib.db import tdb_cassandra
-from r2.lib.filters import generate_table_of_contents, unsafe, wikimarkdown
+from r2.lib.filters import (
+    fragment_inner_html,
+    generate_table_of_contents,
+    unsafe,
+    wikimarkdown,
+)
 from r2.lib.pages import PolicyPage, PolicyView
 from r2.lib.validator import nop, validate
 from r2.models.subreddit import Frontpage
@@ -83,15 +88,17 @@ class PoliciesController(RedditController):
 
         doc_html = wikimarkdown(display_rev.content, include_toc=False)
         if isinstance(doc_html, bytes):
-            soup = BeautifulSoup(doc_html.decode('utf-8'))
-        else:
-            soup = BeautifulSoup(doc_html)
-        toc = generate_table_of_contents(soup, prefix='section')
-        self._number_sections(soup)
-        self._linkify_headings(soup)
+            doc_html = doc_html.decode('utf-8')
+        tree = lxml.html.fragment_fromstring(doc_html, create_parent='div')
+        toc = generate_table_of_contents(tree, prefix='section')
+        self._number_sections(tree)
+        self._linkify_headings(tree)
+
+        if toc is not None:
+            toc = lxml.html.tostring(toc, encoding='unicode')
 
         content = PolicyView(
-            body_html=unsafe(soup),
+            body_html=unsafe(fragment_inner_html(tree)),
             toc_html=unsafe(toc),
             revs=rev_info,
             display_rev=str(display_rev._id),
@@ -101,23 +108,25 @@ class PoliciesController(RedditController):
             content=content,
         ).render()
 
-    def _number_sections(self, soup):
+    def _number_sections(self, tree):
         count = 1
-        for para in soup.find('div', 'md').findAll(['p'], recursive=False):
-            a = Tag(soup, 'a', [
-                ('class', 'p-anchor'),
-                ('id', 'p_%d' % count),
-                ('href', '#p_%d' % count),
-            ])
-            a.append(str(count))
+        md_el = tree.find_class('md')[0]
+        for para in md_el.iterchildren('p'):
+            a = lxml.html.Element('a', {
+                'class': 'p-anchor',
+                'id': 'p_%d' % count,
+                'href': '#p_%d' % count,
+            })
+            a.text = str(count)
+            a.tail = ' ' + (para.text or '')
+            para.text = None
             para.insert(0, a)
-            para.insert(1, ' ')
             count += 1
 
-    def _linkify_headings(self, soup):
-        md_el = soup.find('div', 'md')
-        for heading in md_el.findAll(['h1', 'h2', 'h3'], recursive=False):
-            heading_a = Tag(soup, "a", [('href', '#%s' % heading['id'])])
-            heading_a.contents = heading.contents
-            heading.contents = []
+    def _linkify_headings(self, tree):
+        md_el = tree.find_class('md')[0]
+        for heading in md_el.iterchildren('h1', 'h2', 'h3'):
+            heading_a = lxml.html.Element('a', {'href': '#%s' % heading.get('id')})
+            heading_a.text, heading.text = heading.text, None
+            heading_a.extend(list(heading))
             heading.append(heading_a)
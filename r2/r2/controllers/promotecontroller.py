@@ -1679,8 +1679,12 @@ class PromoteApiController(ApiController):
             self.abort404()
 
         template = "<script>parent.__s3_callbacks__[%(callback)s](%(data)s);</script>"
-        image = _key_to_dict(
-            s3_helpers.get_key(g.s3_client_uploads_bucket, key))
+        s3_key = s3_helpers.get_key(
+            g.s3_client_uploads_bucket, key, check_exists=True)
+        if s3_key is None:
+            self.abort404()
+
+        image = _key_to_dict(s3_key)
         response = {
             "callback": scriptsafe_dumps(callback),
             "data": scriptsafe_dumps(image),
@@ -241,12 +241,14 @@ class Globals:
             'debug',
             'log_start',
             'sqlprinting',
+            'slow_query_logging',
             'template_debug',
             'reload_templates',
             'uncompressedJS',
             'css_killswitch',
             'db_create_tables',
             'disallow_db_writes',
+            'db_query_hints',
             'disable_ratelimit',
             'amqp_logging',
             'read_only_mode',
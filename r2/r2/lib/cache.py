@@ -276,9 +276,14 @@ class HardCache(CacheUtils):
         return results
 
     def set_multi(self, keys, prefix='', time=0):
+        category_bundles = {}
         for k,v in keys.items():
             if v != NoneResult:
-                self.set(prefix+str(k), v, time=time)
+                category, ids = self._split_key(prefix+str(k))
+                category_bundles.setdefault(category, {})[ids] = v
+
+        for category, items in category_bundles.items():
+            self.backend.set_multi(category, items, time)
 
     def get(self, key, default=None):
         category, ids = self._split_key(key)
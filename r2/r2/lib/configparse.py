@@ -20,6 +20,7 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
+import functools
 import re
 
 
@@ -55,7 +56,10 @@ class ConfigValue:
     def set(v, key=None):
         return set(ConfigValue.to_iter(v))
 
+    # the parser factories are memoized so that specs asking for the same
+    # parser share it instead of each building their own closure
     @staticmethod
+    @functools.lru_cache(maxsize=128)
     def set_of(value_type, delim=','):
         def parse(v, key=None):
             return {value_type(x)
@@ -63,13 +67,15 @@ class ConfigValue:
         return parse
 
     @staticmethod
+    @functools.lru_cache(maxsize=128)
     def tuple_of(value_type, delim=','):
         def parse(v, key=None):
-            return tuple(value_type(x)
-                         for x in ConfigValue.to_iter(v, delim=delim))
+            return tuple([value_type(x)
+                          for x in ConfigValue.to_iter(v, delim=delim)])
         return parse
 
     @staticmethod
+    @functools.lru_cache(maxsize=128)
     def dict(key_type, value_type, delim=',', kvdelim=':'):
         def parse(v, key=None):
             values = (i.partition(kvdelim)
@@ -88,7 +94,9 @@ class ConfigValue:
 
     @staticmethod
     def to_iter(v, delim = ','):
-        return (x.strip() for x in v.split(delim) if x)
+        # every caller consumes all of it, and tuple()/set() are built
+        # faster from a list than from a generator
+        return [x.strip() for x in v.split(delim) if x]
 
     @staticmethod
     def timeinterval(v, key=None):
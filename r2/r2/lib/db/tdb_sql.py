@@ -23,10 +23,12 @@
 import logging
 import pickle as pickle
 import threading
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 
 import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from pylons import app_globals as g
 from pylons import request
 from pylons import tmpl_context as c
@@ -34,6 +36,7 @@ from pylons import tmpl_context as c
 from r2.lib import filters
 from r2.lib.utils import (
     Results,
+    in_chunks,
     iters,
     simple_traceback,
     storage,
@@ -47,6 +50,25 @@ predefined_type_ids = g.predefined_type_ids
 log_format = logging.Formatter('sql: %(message)s')
 max_val_len = 1000
 
+# tagging queries with the request and a traceback is only worth its cost
+# when someone is going to read the query log
+annotate_queries = g.sqlprinting or g.config.get('slow_query_logging', False)
+# add pg_hint_plan hints to queries whose plans postgres tends to get wrong
+query_hints = g.config.get('db_query_hints', False)
+
+
+def finish_connection(conn, method):
+    """Commit or roll back conn, closing it either way."""
+    try:
+        getattr(conn, method)()
+    finally:
+        conn.close()
+
+
+# shared by all threads' TransactionSets to finish multi-db transactions
+finish_pool = ThreadPoolExecutor(max_workers=8,
+                                 thread_name_prefix='tdb_sql_finish')
+
 
 class TransactionSet(threading.local):
     """A manager for SQL transactions.
@@ -87,19 +109,32 @@ class TransactionSet(threading.local):
 
     def commit(self):
         """Commit the meta-transaction."""
-        try:
-            for conn in self.connections.values():
-                conn.commit()
-                conn.close()
-        finally:
-            self._clear()
+        self._finish('commit')
 
     def rollback(self):
         """Roll back the meta-transaction."""
+        self._finish('rollback')
+
+    def _finish(self, method):
+        """Commit or roll back every connection.
+
+        When several databases are involved their round trips are issued
+        concurrently. Every connection is finished and closed before the
+        first error (if any) is raised.
+
+        """
         try:
-            for conn in self.connections.values():
-                conn.rollback()
-                conn.close()
+            conns = list(self.connections.values())
+            if len(conns) > 1:
+                futures = [finish_pool.submit(finish_connection, conn, method)
+                           for conn in conns]
+                errors = [f.exception() for f in futures]
+                for e in errors:
+                    if e is not None:
+                        raise e
+            else:
+                for conn in conns:
+                    finish_connection(conn, method)
         finally:
             self._clear()
 
@@ -113,17 +148,52 @@ transactions = TransactionSet()
 MAX_THING_ID = 9223372036854775807 # http://www.postgresql.org/docs/8.3/static/datatype-numeric.html
 MIN_THING_ID = 0
 
+def prepend_request_info(conn, cursor, statement, parameters, context,
+                         executemany):
+    """Add the comment from add_request_info to the SQL sent to the db.
+
+    The comment travels as an execution option rather than being part of
+    the statement so that it doesn't defeat SQLAlchemy's compiled statement
+    cache. It goes at the end so that pg_hint_plan still finds any hint
+    comment at the head of the query.
+
+    """
+    comment = context.execution_options.get('request_info')
+    if comment:
+        statement = statement + '\n' + comment
+    return statement, parameters
+
 def make_metadata(engine):
     metadata = sa.MetaData()
     # Store engine reference for SQLAlchemy 2.0 compatibility
     metadata._engine = engine
     engine.echo = g.sqlprinting
+    if annotate_queries and not sa.event.contains(
+            engine, 'before_cursor_execute', prepend_request_info):
+        sa.event.listen(engine, 'before_cursor_execute', prepend_request_info,
+                        retval=True)
     return metadata
 
 def get_engine_from_table(table):
     """Get the engine associated with a table (SQLAlchemy 2.0 compat)."""
     return table.metadata._engine
 
+read_engines = {}
+
+def read_engine(engine):
+    """Get an autocommit view of engine for selects outside a transaction.
+
+    This saves the BEGIN/COMMIT round trips that psycopg2 otherwise wraps
+    around every read.
+
+    """
+    try:
+        return read_engines[engine]
+    except KeyError:
+        ro_engine = engine.execution_options(isolation_level="AUTOCOMMIT")
+        read_engines[engine] = ro_engine
+        return ro_engine
+
 def execute_statement(table, stmt, params=None):
     """Execute a statement using the table's engine with proper connection handling."""
     engine = get_engine_from_table(table)
@@ -269,6 +339,38 @@ def get_rel_table(metadata, name):
     rel_table.rel_name = name
     return rel_table
 
+# the thing/data/rel schemas are identical on every shard, so each table is
+# declared once and copied into the per-engine metadata
+table_prototypes = {}
+
+def get_table_prototype(make_table, name):
+    key = (make_table, name)
+    if key not in table_prototypes:
+        table_prototypes[key] = make_table(sa.MetaData(), name)
+    return table_prototypes[key]
+
+def copy_table(table, metadata):
+    """Copy a prototype table into metadata, keeping our extra attributes."""
+    new_table = table.to_metadata(metadata)
+    for attr in ('thing_name', 'rel_name'):
+        if hasattr(table, attr):
+            setattr(new_table, attr, getattr(table, attr))
+    return new_table
+
+# sort names that don't map directly onto a thing table column
+sort_column_builders = {
+    'id': lambda t: t.c.thing_id,
+    'hot': lambda t: sa.func.hot(t.c.ups, t.c.downs, t.c.date),
+    'score': lambda t: sa.func.score(t.c.ups, t.c.downs),
+    'controversy': lambda t: sa.func.controversy(t.c.ups, t.c.downs),
+}
+
+def bake_sort_columns(thing_table):
+    """Build the sort expressions for a thing table once, up front."""
+    thing_table.sort_columns = {name: build(thing_table)
+                                for name, build in sort_column_builders.items()}
+    return thing_table
+
 #get/create the type tables
 def make_type_table():
     metadata = make_metadata(dbm.type_db)
@@ -337,12 +439,14 @@ def build_thing_tables():
             metadata = make_metadata(engine)
 
             #make thing table
-            thing_table = get_thing_table(metadata, name)
+            thing_table = bake_sort_columns(copy_table(
+                get_table_prototype(get_thing_table, name), metadata))
             create_table(thing_table,
                          index_commands(thing_table, 'thing'))
 
             #make data tables
-            data_table = get_data_table(metadata, name)
+            data_table = copy_table(
+                get_table_prototype(get_data_table, name), metadata)
             create_table(data_table,
                          index_commands(data_table, 'data'))
 
@@ -373,18 +477,23 @@ def build_rel_tables():
             metadata = make_metadata(engine)
 
             #relation table
-            rel_table = get_rel_table(metadata, name)
+            rel_table = copy_table(
+                get_table_prototype(get_rel_table, name), metadata)
             create_table(rel_table, index_commands(rel_table, 'rel'))
 
             #make thing tables
-            rel_t1_table = get_thing_table(metadata, type1_name)
+            rel_t1_table = bake_sort_columns(copy_table(
+                get_table_prototype(get_thing_table, type1_name), metadata))
             if type1_name == type2_name:
                 rel_t2_table = rel_t1_table
             else:
-                rel_t2_table = get_thing_table(metadata, type2_name)
+                rel_t2_table = bake_sort_columns(copy_table(
+                    get_table_prototype(get_thing_table, type2_name),
+                    metadata))
 
             #build the data
-            rel_data_table = get_data_table(metadata, 'rel_' + name)
+            rel_data_table = copy_table(
+                get_table_prototype(get_data_table, 'rel_' + name), metadata)
             create_table(rel_data_table,
                          index_commands(rel_data_table, 'data'))
 
@@ -410,10 +519,29 @@ def get_write_table(tables):
     else:
         return tables[0]
 
+class SanitizeTable(dict):
+    """str.translate table mapping every non-alphanumeric character to '.'.
+
+    Entries are filled in on first use so that non-ascii letters are kept,
+    matching str.isalnum.
+
+    """
+
+    def __missing__(self, codepoint):
+        char = chr(codepoint)
+        replacement = char if char.isalnum() else "."
+        self[codepoint] = replacement
+        return replacement
+
+sanitize_table = SanitizeTable()
+
+@lru_cache(maxsize=1024)
+def sanitize(txt):
+    return filters._force_utf8(txt).translate(sanitize_table)
+
 def add_request_info(select):
-    def sanitize(txt):
-        return "".join(x if x.isalnum() else "."
-                       for x in filters._force_utf8(txt))
+    if not annotate_queries:
+        return select
 
     tb = simple_traceback(limit=12)
     try:
@@ -424,7 +552,7 @@ def add_request_info(select):
                 tb or "", 
                 sanitize(request.fullpath),
                 sanitize(request.ip))
-            return select.prefix_with(comment)
+            return select.execution_options(request_info=comment)
     except UnicodeDecodeError:
         pass
 
@@ -450,15 +578,27 @@ def get_table(kind, action, tables, avoid_master_reads = False):
             return dbm.get_read_table(tables)
 
 
+# which table to use depends on the request (c.use_write_db) and is picked
+# at random among the read replicas, so only the per-type lookup is cached
+@lru_cache(maxsize=None)
+def thing_table_info(type_id):
+    thing = types_id[type_id]
+    return 't' + str(type_id), thing.tables, thing.avoid_master_reads
+
+@lru_cache(maxsize=None)
+def rel_table_info(rel_type_id):
+    rel = rel_types_id[rel_type_id]
+    return 'r' + str(rel_type_id), rel.tables, rel.avoid_master_reads
+
 def get_thing_table(type_id, action = 'read' ):
-    return get_table('t' + str(type_id), action,
-                     types_id[type_id].tables,
-                     avoid_master_reads = types_id[type_id].avoid_master_reads)
+    kind, tables, avoid_master_reads = thing_table_info(type_id)
+    return get_table(kind, action, tables,
+                     avoid_master_reads = avoid_master_reads)
 
 def get_rel_table(rel_type_id, action = 'read'):
-    return get_table('r' + str(rel_type_id), action,
-                     rel_types_id[rel_type_id].tables,
-                     avoid_master_reads = rel_types_id[rel_type_id].avoid_master_reads)
+    kind, tables, avoid_master_reads = rel_table_info(rel_type_id)
+    return get_table(kind, action, tables,
+                     avoid_master_reads = avoid_master_reads)
 
 
 #TODO does the type actually exist?
@@ -499,8 +639,7 @@ def set_thing_props(type_id, thing_id, **props):
     def do_update(t):
         engine = get_engine_from_table(t)
         transactions.add_engine(engine)
-        new_props = {t.c[prop]: val for prop, val in props.items()}
-        u = t.update().where(t.c.thing_id == thing_id).values(new_props)
+        u = t.update().where(t.c.thing_id == thing_id).values(**props)
         execute_statement(t, u)
 
     do_update(table)
@@ -550,24 +689,28 @@ def set_rel_props(rel_type_id, rel_id, **props):
     #use real columns
     engine = get_engine_from_table(t)
     transactions.add_engine(engine)
-    new_props = {t.c[prop]: val for prop, val in props.items()}
-    u = t.update().where(t.c.rel_id == rel_id).values(new_props)
+    u = t.update().where(t.c.rel_id == rel_id).values(**props)
     execute_statement(t, u)
 
 
+# exact types seen on nearly every call, checked before the isinstance chain
+py2db_kinds = {str: 'str', int: 'num', float: 'num'}
+
 def py2db(val, return_kind=False):
-    if isinstance(val, bool):
-        val = 't' if val else 'f'
-        kind = 'bool'
-    elif isinstance(val, str):
-        kind = 'str'
-    elif isinstance(val, (int, float)):
-        kind = 'num'
-    elif val is None:
-        kind = 'none'
-    else:
-        kind = 'pickle'
-        val = pickle.dumps(val)
+    kind = py2db_kinds.get(type(val))
+    if kind is None:
+        if isinstance(val, bool):
+            val = 't' if val else 'f'
+            kind = 'bool'
+        elif isinstance(val, str):
+            kind = 'str'
+        elif isinstance(val, (int, float)):
+            kind = 'num'
+        elif val is None:
+            kind = 'none'
+        else:
+            kind = 'pickle'
+            val = pickle.dumps(val)
 
     if return_kind:
         return (val, kind)
@@ -599,35 +742,38 @@ def db2py(val, kind):
     return val
 
 
-def update_data(table, thing_id, **vals):
-    engine = get_engine_from_table(table)
-    transactions.add_engine(engine)
-
-    inserts = []
+def make_data_rows(thing_id, vals):
+    rows = []
     for key, val in vals.items():
         val, kind = py2db(val, return_kind=True)
+        rows.append({'thing_id': thing_id, 'key': key, 'value': val, 'kind': kind})
+    return rows
 
-        u = table.update().where(
-            sa.and_(table.c.thing_id == thing_id, table.c.key == key)
-        ).values(value=val, kind=kind)
-        uresult = execute_statement(table, u)
-        if not uresult.rowcount:
-            inserts.append({'thing_id': thing_id, 'key': key, 'value': val, 'kind': kind})
 
-    #do one insert
-    if inserts:
-        for ins in inserts:
-            execute_statement(table, table.insert().values(**ins))
+def update_data(table, thing_id, **vals):
+    if not vals:
+        return
+
+    engine = get_engine_from_table(table)
+    transactions.add_engine(engine)
+
+    #upsert every key in one statement
+    i = pg_insert(table).values(make_data_rows(thing_id, vals))
+    i = i.on_conflict_do_update(
+        index_elements=[table.c.thing_id, table.c.key],
+        set_={'value': i.excluded.value, 'kind': i.excluded.kind})
+    execute_statement(table, i)
 
 
 def create_data(table, thing_id, **vals):
+    if not vals:
+        return
+
     engine = get_engine_from_table(table)
     transactions.add_engine(engine)
 
-    for key, val in vals.items():
-        val, kind = py2db(val, return_kind=True)
-        execute_statement(table, table.insert().values(
-            thing_id=thing_id, key=key, value=val, kind=kind))
+    execute_statement(table, table.insert().values(
+        make_data_rows(thing_id, vals)))
 
 
 def incr_data_prop(table, type_id, thing_id, prop, amount):
@@ -639,6 +785,8 @@ def incr_data_prop(table, type_id, thing_id, prop, amount):
     ).values({t.c.value: sa.cast(t.c.value, sa.Float) + amount})
     execute_statement(t, u)
 
+fetch_chunk_size = 1000
+
 def fetch_query(table, id_col, thing_id):
     """pull the columns from the thing/data tables for a list or single
     thing_id"""
@@ -648,12 +796,15 @@ def fetch_query(table, id_col, thing_id):
         single = True
         thing_id = (thing_id,)
 
-    s = sa.select(table).where(id_col.in_(thing_id))
     engine = get_engine_from_table(table)
 
     try:
-        with engine.connect() as conn:
-            r = conn.execute(add_request_info(s)).fetchall()
+        with read_engine(engine).connect() as conn:
+            #split huge IN lists into batches so each plan stays small
+            r = []
+            for chunk in in_chunks(thing_id, size=fetch_chunk_size):
+                s = sa.select(table).where(id_col.in_(chunk))
+                r.extend(conn.execute(add_request_info(s)).fetchall())
     except Exception:
         dbm.mark_dead(engine)
         # this thread must die so that others may live
@@ -758,8 +909,16 @@ def del_rel(rel_type_id, rel_id):
     transactions.add_engine(engine)
     transactions.add_engine(data_engine)
 
-    execute_statement(table, table.delete().where(table.c.rel_id == rel_id))
-    execute_statement(data_table, data_table.delete().where(data_table.c.thing_id == rel_id))
+    rel_delete = table.delete().where(table.c.rel_id == rel_id)
+    data_delete = data_table.delete().where(data_table.c.thing_id == rel_id)
+
+    if engine is data_engine:
+        #same database: delete both in one statement
+        execute_statement(data_table,
+                          data_delete.add_cte(rel_delete.cte('deleted_rel')))
+    else:
+        execute_statement(table, rel_delete)
+        execute_statement(data_table, data_delete)
 
 def sa_op(op):
     #if BooleanOp
@@ -790,9 +949,50 @@ def sa_op(op):
 
     if not rval:
         return '2+2=5'
+    elif (isinstance(op, operators.eq) and len(rval) > 1 and
+          not any(v is None or isinstance(v, sa.ClauseElement)
+                  for v in rval)):
+        # a single IN keeps the same statement shape whatever the number
+        # of values, where a chain of ORs would compile anew for each
+        # length. None has to stay on the OR path, where it becomes IS NULL
+        return op.lval.in_(rval)
     else:
         return sa.or_(*[fn(op.lval, v) for v in rval])
 
+def add_query_hints(select, hints):
+    """Prefix select with pg_hint_plan hints, if hinting is enabled.
+
+    hints is a list of hint strings like "IndexScan(reddit_thing_link)".
+
+    """
+    if not query_hints or not hints:
+        return select
+    return select.prefix_with("/*+ %s */" % " ".join(hints),
+                              dialect='postgresql')
+
+def pkey_scan_hint(table):
+    return "IndexScan({t} {t}_pkey)".format(t=table.name)
+
+def copy_constraints(constraints):
+    """Copy a constraint tree so its ops' lval/rval can be rewritten.
+
+    The find_* functions only ever reassign lval and rval on each op, so
+    the ops and the boolean ops holding them are copied and everything
+    else is shared. This is much cheaper than a deepcopy.
+
+    """
+    copied = []
+    for o in constraints:
+        if isinstance(o, operators.op):
+            new_op = o.__class__.__new__(o.__class__)
+            new_op.__dict__.update(o.__dict__)
+            copied.append(new_op)
+        elif isinstance(o, operators.BooleanOp):
+            copied.append(o.__class__(*copy_constraints(o.ops)))
+        else:
+            copied.append(o)
+    return copied
+
 def translate_sort(table, column_name, lval = None, rewrite_name = True):
     if isinstance(lval, operators.query_func):
         fn_name = lval.__class__.__name__
@@ -802,26 +1002,27 @@ def translate_sort(table, column_name, lval = None, rewrite_name = True):
                                       lval.lval,
                                       rewrite_name))
 
-    if rewrite_name:
-        if column_name == 'id':
-            return table.c.thing_id
-        elif column_name == 'hot':
-            return sa.func.hot(table.c.ups, table.c.downs, table.c.date)
-        elif column_name == 'score':
-            return sa.func.score(table.c.ups, table.c.downs)
-        elif column_name == 'controversy':
-            return sa.func.controversy(table.c.ups, table.c.downs)
+    if rewrite_name and column_name in sort_column_builders:
+        baked = getattr(table, 'sort_columns', None)
+        if baked is not None:
+            return baked[column_name]
+        return sort_column_builders[column_name](table)
     #else
     return table.c[column_name]
 
 #TODO - only works with thing tables
-def add_sort(sort, t_table, select):
+def add_sort(sort, t_table, select, cols=None):
+    """Order select by sort, returning the new select.
+
+    If cols is given, the (column, table) pair behind each sort is appended
+    to it so the caller can add any joins they need.
+
+    """
     sort = tup(sort)
 
     prefixes = list(t_table.keys()) if isinstance(t_table, dict) else None
     #sort the prefixes so the longest come first
     prefixes.sort(key = lambda x: len(x))
-    cols = []
 
     def make_sa_sort(s):
         orig_col = s.col
@@ -860,7 +1061,8 @@ def add_sort(sort, t_table, select):
             pass
 
         #keep track of which columns we added so we can add joins later
-        cols.append((real_col, table))
+        if cols is not None:
+            cols.append((real_col, table))
 
         #default to asc
         return (sa.desc(real_col) if isinstance(s, operators.desc)
@@ -871,9 +1073,7 @@ def add_sort(sort, t_table, select):
     sa_sort = [make_sa_sort(s) for s in sort]
 
     select = select_ref[0]
-    s = select.order_by(*sa_sort)
-
-    return s, cols
+    return select.order_by(*sa_sort)
 
 def translate_thing_value(rval):
     if isinstance(rval, operators.timeago):
@@ -881,10 +1081,45 @@ def translate_thing_value(rval):
     else:
         return rval
 
+stream_batch_size = 1000
+
+def execute_find(engine, select, stream=False):
+    """Run a find_* query, returning its result and any open connection.
+
+    Normally the rows are buffered client side and the connection goes
+    straight back to the pool. With stream a server-side cursor pulls the
+    rows in batches instead, and the connection stays checked out until
+    the Results wrapping it is exhausted or closed.
+
+    """
+    select = add_request_info(select)
+    try:
+        if not stream:
+            with read_engine(engine).connect() as conn:
+                return conn.execute(select), None
+
+        # server-side cursors need a transaction, so no autocommit here
+        conn = engine.connect()
+        try:
+            r = conn.execution_options(
+                stream_results=True,
+                yield_per=stream_batch_size,
+            ).execute(select)
+        except Exception:
+            conn.close()
+            raise
+        return r, conn
+    except Exception:
+        dbm.mark_dead(engine)
+        # this thread must die so that others may live
+        raise
+
 #will assume parameters start with a _ for consistency
-def find_things(type_id, sort, limit, offset, constraints):
+def find_things(type_id, sort, limit, offset, constraints, hints=None,
+                stream=False):
     table = get_thing_table(type_id)[0]
-    constraints = deepcopy(constraints)
+    constraints = copy_constraints(constraints)
+    hints = list(hints or ())
 
     s = sa.select(table.c.thing_id.label('thing_id'))
 
@@ -892,6 +1127,9 @@ def find_things(type_id, sort, limit, offset, constraints):
         #assume key starts with _
         #if key.startswith('_'):
         key = op.lval_name
+        if key == '_id' and not hints:
+            # lookups by id should always use the primary key
+            hints.append(pkey_scan_hint(table))
         op.lval = translate_sort(table, key[1:], op.lval)
         op.rval = translate_thing_value(op.rval)
 
@@ -899,7 +1137,7 @@ def find_things(type_id, sort, limit, offset, constraints):
         s = s.where(sa_op(op))
 
     if sort:
-        s, cols = add_sort(sort, {'_': table}, s)
+        s = add_sort(sort, {'_': table}, s)
 
     if limit:
         s = s.limit(limit)
@@ -907,15 +1145,11 @@ def find_things(type_id, sort, limit, offset, constraints):
     if offset:
         s = s.offset(offset)
 
+    s = add_query_hints(s, hints)
+
     engine = get_engine_from_table(table)
-    try:
-        with engine.connect() as conn:
-            r = conn.execute(add_request_info(s))
-    except Exception:
-        dbm.mark_dead(engine)
-        # this thread must die so that others may live
-        raise
-    return Results(r, lambda row: row.thing_id)
+    r, conn = execute_find(engine, s, stream)
+    return Results(r, lambda row: row.thing_id, connection=conn)
 
 def translate_data_value(alias, op):
     lval = op.lval
@@ -934,9 +1168,10 @@ def translate_data_value(alias, op):
 
 #TODO sort by data fields
 #TODO sort by id wants thing_id
-def find_data(type_id, sort, limit, offset, constraints):
+def find_data(type_id, sort, limit, offset, constraints, hints=None,
+              stream=False):
     t_table, d_table = get_thing_table(type_id)
-    constraints = deepcopy(constraints)
+    constraints = copy_constraints(constraints)
 
     used_first = False
     need_join = False
@@ -949,7 +1184,6 @@ def find_data(type_id, sort, limit, offset, constraints):
 
     for op in operators.op_iter(constraints):
         key = op.lval_name
-        vals = tup(op.rval)
 
         if key == '_id':
             op.lval = first_alias.c.thing_id
@@ -992,10 +1226,13 @@ def find_data(type_id, sort, limit, offset, constraints):
     #TODO in order to sort by data columns, this is going to need to be smarter
     if sort:
         need_join = True
-        s, cols = add_sort(sort, {'_':t_table}, s)
+        s = add_sort(sort, {'_':t_table}, s)
 
     if need_join:
         s = s.where(first_alias.c.thing_id == t_table.c.thing_id)
+        if hints is None:
+            # the join to the thing table is always by primary key
+            hints = [pkey_scan_hint(t_table)]
 
     if limit:
         s = s.limit(limit)
@@ -1003,33 +1240,32 @@ def find_data(type_id, sort, limit, offset, constraints):
     if offset:
         s = s.offset(offset)
 
+    s = add_query_hints(s, hints)
+
     engine = get_engine_from_table(t_table)
-    try:
-        with engine.connect() as conn:
-            r = conn.execute(add_request_info(s))
-    except Exception:
-        dbm.mark_dead(engine)
-        # this thread must die so that others may live
-        raise
+    r, conn = execute_find(engine, s, stream)
 
-    return Results(r, lambda row: row.thing_id)
+    return Results(r, lambda row: row.thing_id, connection=conn)
 
 
-def sort_thing_ids_by_data_value(type_id, thing_ids, value_name,
-        limit=None, desc=False):
-    """Order thing_ids by the value of a data column."""
+@lru_cache(maxsize=16)
+def sort_thing_ids_query(thing_table, data_table, desc, limit):
+    """Build the select for sort_thing_ids_by_data_value.
 
-    thing_table, data_table = get_thing_table(type_id)
+    The ids and value name are bind parameters, so the same select (and
+    its compiled form) is reused for every call with the same tables,
+    direction and limit.
 
+    """
     join = thing_table.join(data_table,
         data_table.c.thing_id == thing_table.c.thing_id)
 
     query = (sa.select(thing_table.c.thing_id)
         .where(sa.and_(
-            thing_table.c.thing_id.in_(thing_ids),
+            thing_table.c.thing_id.in_(sa.bindparam('ids', expanding=True)),
             thing_table.c.deleted == False,
             thing_table.c.spam == False,
-            data_table.c.key == value_name,
+            data_table.c.key == sa.bindparam('value_name'),
         ))
         .select_from(join)
     )
@@ -1042,17 +1278,34 @@ def sort_thing_ids_by_data_value(type_id, thing_ids, value_name,
     if limit:
         query = query.limit(limit)
 
+    # thing_ids is the selective side: walk it and probe the data table's
+    # (thing_id, key) index rather than scanning the data table
+    return add_query_hints(query, [
+        "Leading(({t} {d}))".format(t=thing_table.name, d=data_table.name),
+        "NestLoop({t} {d})".format(t=thing_table.name, d=data_table.name),
+        "IndexScan(%s)" % data_table.name,
+    ])
+
+def sort_thing_ids_by_data_value(type_id, thing_ids, value_name,
+        limit=None, desc=False):
+    """Order thing_ids by the value of a data column."""
+
+    thing_table, data_table = get_thing_table(type_id)
+    query = sort_thing_ids_query(thing_table, data_table, desc, limit)
+
     engine = get_engine_from_table(thing_table)
-    with engine.connect() as conn:
-        rows = conn.execute(query)
+    with read_engine(engine).connect() as conn:
+        rows = conn.execute(query, {'ids': list(thing_ids),
+                                    'value_name': value_name})
 
     return Results(rows, lambda row: row.thing_id)
 
 
-def find_rels(ret_props, rel_type_id, sort, limit, offset, constraints):
+def find_rels(ret_props, rel_type_id, sort, limit, offset, constraints,
+              hints=None, stream=False):
     tables = get_rel_table(rel_type_id)
     r_table, t1_table, t2_table, d_table = tables
-    constraints = deepcopy(constraints)
+    constraints = copy_constraints(constraints)
 
     t1_table, t2_table = t1_table.alias(), t2_table.alias()
 
@@ -1084,7 +1337,6 @@ def find_rels(ret_props, rel_type_id, sort, limit, offset, constraints):
     joins_needed = set()
 
     for op in operators.op_iter(constraints):
-        #vals = con.rval
         key = op.lval_name
         prefix = key[:4]
 
@@ -1102,8 +1354,6 @@ def find_rels(ret_props, rel_type_id, sort, limit, offset, constraints):
             table = join[1]
             op.lval = translate_sort(table, key, op.lval)
             op.rval = translate_thing_value(op.rval)
-            #ors = [sa_op(con, key, v) for v in vals]
-            #s.append_whereclause(sa.or_(*ors))
 
         elif prefix.startswith('_'):
             op.lval = r_table.c[key[1:]]
@@ -1127,10 +1377,12 @@ def find_rels(ret_props, rel_type_id, sort, limit, offset, constraints):
         s = s.where(sa_op(op))
 
     if sort:
-        s, cols = add_sort(
+        cols = []
+        s = add_sort(
             sort=sort,
             t_table={'_': r_table, '_t1_': t1_table, '_t2_': t2_table},
             select=s,
+            cols=cols,
         )
 
         #do we need more joins?
@@ -1150,24 +1402,17 @@ def find_rels(ret_props, rel_type_id, sort, limit, offset, constraints):
     if offset:
         s = s.offset(offset)
 
+    s = add_query_hints(s, hints)
+
     engine = get_engine_from_table(r_table)
-    try:
-        with engine.connect() as conn:
-            r = conn.execute(add_request_info(s))
-    except Exception:
-        dbm.mark_dead(engine)
-        # this thread must die so that others may live
-        raise
+    r, conn = execute_find(engine, s, stream)
 
     def build_fn(row):
-        # return Storage objects with just the requested props
-        props = {}
-        for prop in ret_props:
-            db_prop = prop[1:]  # column name doesn't have _ prefix
-            props[prop] = getattr(row, db_prop)
-        return storage(**props)
-
-    return Results(sa_ResultProxy=r, build_fn=build_fn)
+        # return Storage objects with just the requested props. they're the
+        # leading columns of the row, in order, so pair them up positionally
+        return storage(zip(ret_props, row))
+
+    return Results(sa_ResultProxy=r, build_fn=build_fn, connection=conn)
 
 
 if logging.getLogger('sqlalchemy').handlers:
@@ -24,8 +24,10 @@ import json
 import re
 from collections import Counter
 
+import lxml.etree
+import lxml.html
 import snudown
-from BeautifulSoup import BeautifulSoup, Tag
+from pylons import app_globals as g
 from pylons import tmpl_context as c
 
 from r2.lib.souptest import (
@@ -44,6 +46,8 @@ WIKI_MD_END = '</div>'
 
 custom_img_url = re.compile(r'\A%%([a-zA-Z0-9\-]+)%%$')
 
+# a chain of str.replace beats a str.translate table here: replace scans
+# with memchr and leaves clean text alone, translate expands char by char
 def python_websafe(text):
     return text.replace('&', "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
 
@@ -63,12 +67,14 @@ try:
 except ImportError:
     c_websafe      = python_websafe
     c_websafe_json = python_websafe_json
-    _between_tags1 = re.compile('> +')
-    _between_tags2 = re.compile(' +<')
-    _spaces = re.compile(r'[\s]+')
+    # whitespace runs collapse to a single space, or vanish entirely
+    # when they border a tag
+    _compress = re.compile(r'(>)\s+|\s+(<)|\s+')
     _ignore = re.compile('(' + SC_OFF + '|' + SC_ON + ')', re.S | re.I)
+    def _compress_sub(m):
+        return m.group(1) or m.group(2) or ' '
     def spaceCompress(content):
-        res = ''
+        res = []
         sc = True
         for p in _ignore.split(content):
             if p == SC_ON:
@@ -76,14 +82,11 @@ except ImportError:
             elif p == SC_OFF:
                 sc = False
             elif sc:
-                p = _spaces.sub(' ', p)
-                p = _between_tags1.sub('>', p)
-                p = _between_tags2.sub('<', p)
-                res += p
+                res.append(_compress.sub(_compress_sub, p))
             else:
-                res += p
+                res.append(p)
 
-        return res
+        return ''.join(res)
 
 
 class _Unsafe(str):
@@ -102,7 +105,14 @@ def double_websafe(text=""):
     # RSS requires double escaping on fields that could be interpreted as HTML
     return unsafe(python_websafe(python_websafe(text)))
 
-def conditional_websafe(text = ''):
+# handlers for conditional_websafe keyed on the exact class of the input.
+# these are filled in on first use because r2.lib.wrapped imports
+# r2.lib.utils, which imports this module.
+_websafe_dispatch = None
+_Templated = _CacheStub = None
+
+def _load_websafe_dispatch():
+    global _websafe_dispatch, _Templated, _CacheStub
     try:
         # older setups may expose a top-level `wrapped` module
         from wrapped import CacheStub, Templated
@@ -110,17 +120,29 @@ def conditional_websafe(text = ''):
         # prefer the compiled/packaged one under r2.lib
         from r2.lib.wrapped import CacheStub, Templated
 
-    if text.__class__ == _Unsafe:
-        return text
-    elif isinstance(text, Templated):
+    _Templated, _CacheStub = Templated, CacheStub
+    _websafe_dispatch = {
+        _Unsafe: lambda text: text,
+        CacheStub: _Unsafe,
+        type(None): lambda text: "",
+    }
+    return _websafe_dispatch
+
+def conditional_websafe(text = ''):
+    # plain strings are by far the most common input, so handle them
+    # before anything else
+    if text.__class__ == str:
+        return c_websafe(text)
+
+    handler = (_websafe_dispatch or _load_websafe_dispatch()).get(
+        text.__class__)
+    if handler is not None:
+        return handler(text)
+    elif isinstance(text, _Templated):
         return _Unsafe(text.render())
-    elif isinstance(text, CacheStub):
+    elif isinstance(text, _CacheStub):
         return _Unsafe(text)
-    elif text is None:
-        return ""
-    elif text.__class__ != str:
-        text = _force_unicode(text)
-    return c_websafe(text)
+    return c_websafe(_force_unicode(text))
 
 
 def mako_websafe(text=''):
@@ -150,7 +172,8 @@ _js_escapes = {
     ord('\u2029'): '\\u2029',
 }
 # Escape every ASCII character with a value less than 32.
-_js_escapes.update((ord('%c' % z), '\\u%04X' % z) for z in range(32))
+_js_escapes.update((z, '\\u%04X' % z) for z in range(32))
+_js_escapes = str.maketrans(_js_escapes)
 
 
 def jssafe(text=''):
@@ -161,11 +184,18 @@ def jssafe(text=''):
     return _Unsafe(text.translate(_js_escapes))
 
 
-_json_escapes = {
-    ord('>'): '\\u003E',
-    ord('<'): '\\u003C',
-    ord('&'): '\\u0026',
-}
+_json_escapes = str.maketrans({
+    '>': '\\u003E',
+    '<': '\\u003C',
+    '&': '\\u0026',
+})
+
+
+def _scriptsafe_default(o):
+    # json can't serialize bytes on its own
+    if isinstance(o, bytes):
+        return o.decode('utf-8')
+    raise TypeError(f'Object of type {o.__class__.__name__} is not JSON serializable')
 
 
 def scriptsafe_dumps(obj, **kwargs):
@@ -186,15 +216,16 @@ def scriptsafe_dumps(obj, **kwargs):
     # Ensure bytes are converted to text when serializing. If the caller
     # provided a `default` serializer, wrap it so bytes are handled first.
     user_default = kwargs.get('default')
-    def _default(o):
-        if isinstance(o, bytes):
-            return o.decode('utf-8')
-        if user_default:
+    if user_default:
+        def _default(o):
+            if isinstance(o, bytes):
+                return o.decode('utf-8')
             return user_default(o)
-        raise TypeError(f'Object of type {o.__class__.__name__} is not JSON serializable')
+        kwargs['default'] = _default
+    else:
+        kwargs['default'] = _scriptsafe_default
 
-    kwargs['default'] = _default
-    text = _force_unicode(json.dumps(obj, **kwargs))
+    text = json.dumps(obj, **kwargs)
     # wrap the response in _Unsafe so conditional_websafe doesn't touch it
     # TODO: this might be a hot path soon, C-ify it?
     return _Unsafe(text.translate(_json_escapes))
@@ -218,121 +249,170 @@ def safemarkdown(text, nofollow=False, wrap=True, **kwargs):
         return None
 
     target = kwargs.get("target", None)
-    text = snudown.markdown(_force_utf8(text), nofollow, target)
+    if text.__class__ != str:
+        text = _force_utf8(text)
+    text = snudown.markdown(text, nofollow, target)
 
+    # join in one go rather than copying the whole document per +
     if wrap:
-        return SC_OFF + MD_START + text + MD_END + SC_ON
+        return ''.join((SC_OFF, MD_START, text, MD_END, SC_ON))
     else:
-        return SC_OFF + text + SC_ON
+        return ''.join((SC_OFF, text, SC_ON))
+
+utf8_html_parser = lxml.html.HTMLParser(encoding='utf-8')
+
+def fragment_inner_html(tree):
+    """Serialize the contents of a fragment parsed with create_parent."""
+    text = lxml.html.tostring(tree, encoding='unicode')
+    # strip the parent's own start and end tags
+    return text[text.index('>') + 1:text.rindex('<')]
+
+# substrings that mean wikimarkdown has images, headers or links to rewrite
+_wiki_tag_markers = {
+    str: ('<img', '<h', '<a '),
+    bytes: (b'<img', b'<h', b'<a '),
+}
+
+# matches urls with a hostname: "scheme://host..." or "//host..."
+has_netloc_re = re.compile(r'\A(?:[a-z][a-z0-9+.-]*:)?//', re.I)
 
 def wikimarkdown(text, include_toc=True, target=None):
+    # these modules import filters themselves, so they can't be imported
+    # at the top of this one
     from r2.lib.template_helpers import add_sr, make_url_protocol_relative
     from r2.lib.utils import UrlParser
 
-    # this hard codes the stylesheet page for now, but should be parameterized
-    # in the future to allow per-page images.
-    from r2.models.wiki import ImagesByWikiPage
-    page_images = ImagesByWikiPage.get_images(c.site, "config/stylesheet")
-    
-    def img_swap(tag):
-        name = tag.get('src')
-        name = custom_img_url.search(name)
-        name = name and name.group(1)
-        if name and name in page_images:
-            url = page_images[name]
-            url = make_url_protocol_relative(url)
-            tag['src'] = url
-        else:
-            tag.extract()
-    
     nofollow = True
-    
-    text = snudown.markdown(_force_utf8(text), nofollow, target,
+
+    if text.__class__ != str:
+        text = _force_utf8(text)
+    text = snudown.markdown(text, nofollow, target,
                             renderer=snudown.RENDERER_WIKI)
+
+    # most pages have nothing for the tree walk below to rewrite, so don't
+    # parse and reserialize them. <h also matches <hr, which is harmless.
+    img_tag, header_tag, link_tag = _wiki_tag_markers[text.__class__]
+    if (img_tag not in text and
+            not (include_toc and header_tag in text) and
+            not (c.render_style == 'compact' and link_tag in text)):
+        if isinstance(text, bytes):
+            text = text.decode('utf-8')
+        return ''.join((SC_OFF, WIKI_MD_START, text, WIKI_MD_END, SC_ON))
     
     # TODO: We should test how much of a load this adds to the app
-    if isinstance(text, bytes):
-        soup = BeautifulSoup(text.decode('utf-8'))
-    else:
-        soup = BeautifulSoup(text)
-    images = soup.findAll('img')
+    # lxml parses snudown's utf-8 directly, no need to decode it first
+    tree = lxml.html.fragment_fromstring(
+        text, create_parent='div',
+        parser=utf8_html_parser if isinstance(text, bytes) else None)
+    # find everything we need to rewrite in a single walk of the tree
+    images, links, headers = [], [], []
+    by_tag = {'img': images, 'a': links}
+    by_tag.update((tag, headers) for tag in header_tags)
+    for el in tree.iter('img', 'a', *header_tags):
+        by_tag[el.tag].append(el)
     
     if images:
+        # this hard codes the stylesheet page for now, but should be
+        # parameterized in the future to allow per-page images.
+        from r2.models.wiki import ImagesByWikiPage
+        page_images = ImagesByWikiPage.get_images(c.site, "config/stylesheet")
+
+        def img_swap(tag):
+            name = tag.get('src')
+            name = name and name.startswith('%%') and custom_img_url.search(name)
+            name = name and name.group(1)
+            if name and name in page_images:
+                url = page_images[name]
+                url = make_url_protocol_relative(url)
+                tag.set('src', url)
+            else:
+                tag.drop_tree()
+
         [img_swap(image) for image in images]
 
     def add_ext_to_link(link):
-        url = UrlParser(link.get('href'))
+        href = link.get('href')
+        # offsite links can't be reddit urls, skip parsing them
+        if (href and has_netloc_re.match(href) and
+                g.domain not in href.lower()):
+            return
+        url = UrlParser(href)
         if url.is_reddit_url():
-            link['href'] = add_sr(link.get('href'), sr_path=False)
+            link.set('href', add_sr(href, sr_path=False))
 
     if c.render_style == 'compact':
-        links = soup.findAll('a')
         [add_ext_to_link(a) for a in links]
 
     if include_toc:
-        tocdiv = generate_table_of_contents(soup, prefix="wiki")
-        if tocdiv:
-            soup.insert(0, tocdiv)
+        tocdiv = generate_table_of_contents(tree, prefix="wiki",
+                                            headers=headers)
+        if tocdiv is not None:
+            # keep any leading text after the toc
+            tocdiv.tail, tree.text = tree.text, None
+            tree.insert(0, tocdiv)
     
-    text = str(soup)
+    text = fragment_inner_html(tree)
     
-    return SC_OFF + WIKI_MD_START + text + WIKI_MD_END + SC_ON
+    return ''.join((SC_OFF, WIKI_MD_START, text, WIKI_MD_END, SC_ON))
 
 title_re = re.compile(r'[^\w.-]')
-header_re = re.compile('^h[1-6]$')
-def generate_table_of_contents(soup, prefix):
+header_tags = ('h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+
+def _title_char_sub(m):
+    return '.%X' % ord(m.group())
+
+def generate_table_of_contents(tree, prefix, headers=None):
+    """Build a table of contents div for the headers in tree.
+
+    Callers that have already walked the tree can pass its headers (in
+    document order) to save another walk.
+
+    """
     header_ids = Counter()
-    headers = soup.findAll(header_re)
+    if headers is None:
+        headers = list(tree.iter(*header_tags))
     if not headers:
         return
-    tocdiv = Tag(soup, "div", [("class", "toc")])
-    parent = Tag(soup, "ul")
-    parent.level = 0
-    tocdiv.append(parent)
-    level = 0
+    tocdiv = lxml.html.Element("div", {"class": "toc"})
+    parent = lxml.etree.SubElement(tocdiv, "ul")
+    # the open lists, innermost last, with the header level of each
+    lists = [(parent, 0)]
     previous = 0
     for header in headers:
-        contents = ''.join(header.findAll(text=True))
+        contents = header.text_content()
         
         # In the event of an empty header, skip
         if not contents:
             continue
         
-        # Convert html entities to avoid ugly header ids
-        aid = str(BeautifulSoup(contents, convertEntities=BeautifulSoup.XML_ENTITIES))
         # Prefix with PREFIX_ to avoid ID conflict with the rest of the page
-        aid = '{}_{}'.format(prefix, aid.replace(" ", "_").lower())
+        aid = '{}_{}'.format(prefix, contents.replace(" ", "_").lower())
         # Convert down to ascii replacing special characters with hex
-        aid = str(title_re.sub(lambda c: '.%X' % ord(c.group()), aid))
+        aid = title_re.sub(_title_char_sub, aid)
         
         # Check to see if a tag with the same ID exists
-        id_num = header_ids[aid] + 1
         header_ids[aid] += 1
+        id_num = header_ids[aid]
         # Only start numbering ids with the second instance of an id
         if id_num > 1:
             aid = '%s%d' % (aid, id_num)
         
-        header['id'] = aid
+        header.set('id', aid)
         
-        li = Tag(soup, "li", [("class", aid)])
-        a = Tag(soup, "a", [("href", "#%s" % aid)])
-        a.string = contents
-        li.append(a)
+        li = lxml.html.Element("li", {"class": aid})
+        a = lxml.etree.SubElement(li, "a", {"href": "#%s" % aid})
+        a.text = contents
         
-        thislevel = int(header.name[-1])
+        thislevel = int(header.tag[-1])
         
         if previous and thislevel > previous:
-            newul = Tag(soup, "ul")
-            newul.level = thislevel
-            newli = Tag(soup, "li", [("class", "toc_child")])
-            newli.append(newul)
-            parent.append(newli)
-            parent = newul
-            level += 1
-        elif level and thislevel < previous:
-            while level and parent.level > thislevel:
-                parent = parent.findParent("ul")
-                level -= 1
+            newli = lxml.etree.SubElement(parent, "li", {"class": "toc_child"})
+            parent = lxml.etree.SubElement(newli, "ul")
+            lists.append((parent, thislevel))
+        elif len(lists) > 1 and thislevel < previous:
+            while len(lists) > 1 and lists[-1][1] > thislevel:
+                lists.pop()
+            parent = lists[-1][0]
         
         previous = thislevel
         parent.append(li)
@@ -340,10 +420,14 @@ def generate_table_of_contents(soup, prefix):
     return tocdiv
 
 
+# a chain of str.replace measures faster here than str.translate or re.sub:
+# the characters are usually rare, so each replace is just a quick scan
+_kept_spaces = tuple((ch, '&#%02d;' % ord(ch)) for ch in " \n\r\t")
+
 def keep_space(text):
     text = websafe(text)
-    for i in " \n\r\t":
-        text=text.replace(i,'&#%02d;' % ord(i))
+    for ch, entity in _kept_spaces:
+        text = text.replace(ch, entity)
     return unsafe(text)
 
 
@@ -20,9 +20,12 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
+import functools
 import random
 from datetime import datetime
 from datetime import timedelta as timedelta
+from datetime import timezone
+from time import monotonic, perf_counter_ns
 
 import pytz
 try:
@@ -69,6 +72,8 @@ except Exception:
             return _raise_missing()
 
     sa = _SAStub()
+else:
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
 from pylons import app_globals as g
 
 from r2.lib.db.tdb_lite import tdb_lite
@@ -76,37 +81,137 @@ from r2.lib.db.tdb_lite import tdb_lite
 COUNT_CATEGORY = 'hc_count'
 ELAPSED_CATEGORY = 'hc_elapsed'
 TZ = pytz.timezone("MST")
-
-
-def _get_engine(table):
-    """Get the engine from a table (SQLAlchemy 2.0 compat)."""
-    return table.metadata._engine
-
-
-def _execute(table, stmt):
+GET_MULTI_PAGE_SIZE = 500
+# replica reads are kept in process for this many seconds. replication lag
+# already makes them this stale, so it doesn't weaken any guarantees
+RECENT_READ_TTL = 1
+RECENT_READ_LIMIT = 4096
+
+
+@functools.lru_cache(maxsize=None)
+def _engine_for(table):
+    """Get an autocommit view of the engine behind a table.
+
+    Every hardcache operation is a single statement, which postgres runs
+    atomically on its own. Running them in autocommit mode saves the BEGIN
+    and COMMIT (or ROLLBACK) round trips of an explicit transaction. The
+    view shares the engine's connection pool.
+
+    """
+    engine = table.metadata._engine
+    return engine.execution_options(isolation_level="AUTOCOMMIT")
+
+
+def _num_plus(value, delta):
+    """SQL for a num-kind value (stored as text) plus delta, as text."""
+    return sa.cast(sa.cast(value, sa.BigInteger) + delta, sa.String)
+
+
+@functools.lru_cache(maxsize=None)
+def _statements(table):
+    """Build the fixed-shape statements the backend runs against a table.
+
+    Their values are all bind parameters, so each is built (and compiled by
+    sqlalchemy) once per table and then just executed with new params.
+
+    """
+    # the update can't use bind names that match its columns
+    key = sa.and_(table.c.category == sa.bindparam('key_category'),
+                  table.c.ids == sa.bindparam('key_ids'))
+
+    insert = pg_insert(table)
+    replace = {
+        'value': insert.excluded.value,
+        'kind': insert.excluded.kind,
+        'expiration': insert.excluded.expiration,
+    }
+    index_elements = [table.c.category, table.c.ids]
+
+    return {
+        'get': sa.select(table.c.value, table.c.kind).where(
+            sa.and_(key, table.c.expiration >= sa.func.now())).limit(1),
+        'delete': table.delete().where(key),
+        # overwrite it if it already exists
+        'set': insert.on_conflict_do_update(
+            index_elements=index_elements, set_=replace),
+        # only replace an existing row if it has expired
+        'add': insert.on_conflict_do_update(
+            index_elements=index_elements, set_=replace,
+            where=table.c.expiration < sa.func.now(),
+        ).returning(table.c.ids),
+        # expired rows are left alone, as though they weren't there
+        'incr': table.update().where(
+            sa.and_(key, table.c.kind == 'num',
+                    table.c.expiration >= sa.func.now())
+        ).values({
+            table.c.value: _num_plus(
+                table.c.value, sa.bindparam('delta', type_=sa.BigInteger)),
+            table.c.expiration: sa.bindparam('new_expiration'),
+        }),
+        # add to a counter, or restart it if it has expired
+        'upsert_counter': insert.on_conflict_do_update(
+            index_elements=index_elements,
+            set_=dict(replace, value=sa.case(
+                (table.c.expiration < sa.func.now(), insert.excluded.value),
+                else_=_num_plus(table.c.value,
+                                sa.cast(insert.excluded.value, sa.BigInteger)),
+            )),
+        ),
+    }
+
+
+def _execute(table, stmt, params=None):
     """Execute a statement and return the result."""
-    engine = _get_engine(table)
-    with engine.connect() as conn:
-        result = conn.execute(stmt)
-        conn.commit()
-        return result
-
-
-def _select(table, stmt):
-    """Execute a select statement and return all rows."""
-    engine = _get_engine(table)
-    with engine.connect() as conn:
-        return conn.execute(stmt).fetchall()
+    with _engine_for(table).connect() as conn:
+        return conn.execute(stmt, params)
+
+
+def _select(table, stmt, params=None):
+    """Execute a select (or a statement with RETURNING) and return all rows."""
+    with _engine_for(table).connect() as conn:
+        return conn.execute(stmt, params).fetchall()
+
+def _partitions(table):
+    """Lightweight tables for the partitions of table, if it has any.
+
+    Tables created before partitioning was added have none, and get an
+    empty list.
+
+    """
+    rows = _select(table, sa.text(
+        "select c.relname from pg_inherits i"
+        " join pg_class c on c.oid = i.inhrelid"
+        " where i.inhparent = cast(:parent as regclass)"
+        " order by c.relname"), dict(parent=table.name))
+    return [sa.table(r.relname,
+                     sa.column('expiration', sa.DateTime(timezone=True)))
+            for r in rows]
+
+def partition_commands(table, categories):
+    """DDL creating a list partition of table for each category, plus a
+    default partition for the rest."""
+    commands = []
+    for i, category in enumerate(categories):
+        commands.append(
+            "create table %s_p%d partition of %s for values in ('%s')" %
+            (table.name, i, table.name, category.replace("'", "''")))
+    commands.append("create table %s_default partition of %s default" %
+                    (table.name, table.name))
+    return commands
 
 def expiration_from_time(time):
     if time <= 0:
         raise ValueError ("HardCache items *must* have an expiration time")
-    return datetime.now(TZ) + timedelta(0, time)
+    # the stdlib utc is much cheaper than localizing with pytz, and the
+    # column is timezone aware, so it's the same instant either way
+    return datetime.now(timezone.utc) + timedelta(0, time)
 
 class HardCacheBackend:
     def __init__(self, gc):
         self.tdb = tdb_lite(gc)
         self.profile_categories = {}
+        # (category, ids) -> (good until, value, kind) for replica reads
+        self.recent_reads = {}
         TZ = gc.display_tz
 
         def _table(metadata):
@@ -119,7 +224,8 @@ class HardCacheBackend:
                             sa.Column('kind', sa.String, nullable = False),
                             sa.Column('expiration',
                                       sa.DateTime(timezone = True),
-                                      nullable = False)
+                                      nullable = False),
+                            postgresql_partition_by = 'LIST (category)',
                             )
         enginenames_by_category = {}
         all_enginenames = set()
@@ -140,13 +246,22 @@ class HardCacheBackend:
 
         assert('*' in list(enginenames_by_category.keys()))
 
+        # each named category (the busy profiling counters included) gets
+        # its own partition so its rows and indexes are kept apart from the
+        # others, and everything else goes in the default partition
+        partition_categories = sorted(
+            (set(enginenames_by_category) - {'*'}) |
+            {COUNT_CATEGORY, ELAPSED_CATEGORY})
+
         engines_by_enginename = {}
         for enginename in all_enginenames:
             engine = gc.dbm.get_engine(enginename)
             md = self.tdb.make_metadata(engine)
             table = _table(md)
             indstr = self.tdb.index_str(table, 'expiration', 'expiration')
-            self.tdb.create_table(table, [ indstr ])
+            self.tdb.create_table(
+                table,
+                partition_commands(table, partition_categories) + [indstr])
             engines_by_enginename[enginename] = table
 
         self.mapping = {}
@@ -154,17 +269,43 @@ class HardCacheBackend:
             self.mapping[category] = [ engines_by_enginename[e]
                                        for e in enginenames]
 
+        # split out once so engine_by_category is just a lookup
+        self.masters = {category: tables[0]
+                        for category, tables in self.mapping.items()}
+        self.readslaves = {category: tuple(tables[1:])
+                           for category, tables in self.mapping.items()}
+
     def engine_by_category(self, category, type="master"):
-        if category not in self.mapping:
-            category = '*'
-        engines = self.mapping[category]
         if type == 'master':
-            return engines[0]
+            try:
+                return self.masters[category]
+            except KeyError:
+                return self.masters['*']
         elif type == 'readslave':
-            return random.choice(engines[1:])
+            try:
+                readslaves = self.readslaves[category]
+            except KeyError:
+                readslaves = self.readslaves['*']
+            return random.choice(readslaves)
         else:
             raise ValueError("invalid type %s" % type)
 
+    def _remember(self, category, ids, value=None, kind=None):
+        if len(self.recent_reads) >= RECENT_READ_LIMIT:
+            self.recent_reads.clear()
+        self.recent_reads[(category, ids)] = (
+            monotonic() + RECENT_READ_TTL, value, kind)
+
+    def _recall(self, category, ids):
+        """Return a recent (good until, value, kind) read, or None."""
+        recent = self.recent_reads.get((category, ids))
+        if recent is not None and recent[0] > monotonic():
+            return recent
+        return None
+
+    def _forget(self, category, ids):
+        self.recent_reads.pop((category, ids), None)
+
     def profile_start(self, operation, category):
         if category == COUNT_CATEGORY:
             return None
@@ -180,33 +321,48 @@ class HardCacheBackend:
         if effective_category not in self.profile_categories:
             return None
 
-        return (datetime.now(TZ), operation, category)
+        return (perf_counter_ns(), operation, category)
 
     def profile_stop(self, t):
         if t is None:
             return
 
-        start_time, operation, category = t
-
-        end_time = datetime.now(TZ)
+        start_ns, operation, category = t
 
-        period = end_time.strftime("%Y/%m/%d_%H:%M")[:-1] + 'x'
+        msec = (perf_counter_ns() - start_ns) // 1000000
 
-        elapsed = end_time - start_time
-        msec = elapsed.seconds * 1000 + elapsed.microseconds / 1000
+        period = datetime.now(TZ).strftime("%Y/%m/%d_%H:%M")[:-1] + 'x'
 
         ids = "-".join((operation, category, period))
 
-        self.add(COUNT_CATEGORY, ids, 0, time=86400)
-        self.add(ELAPSED_CATEGORY, ids, 0, time=86400)
+        self._upsert_counters(
+            ((COUNT_CATEGORY, 1), (ELAPSED_CATEGORY, msec)), ids, time=86400)
 
-        self.incr(COUNT_CATEGORY, ids, time=86400)
-        self.incr(ELAPSED_CATEGORY, ids, time=86400, delta=msec)
+    def _upsert_counters(self, deltas, ids, time):
+        """Add each (category, delta) to its counter for ids, creating it (or
+        restarting it if it has expired) in the same statement.
 
+        Counters that live in the same table are written together, as one
+        multi-row statement.
+        """
+        expiration = expiration_from_time(time)
 
-    def set(self, category, ids, val, time):
+        params_by_table = {}
+        for category, delta in deltas:
+            table = self.engine_by_category(category, "master")
+            params_by_table.setdefault(table, []).append(dict(
+                category=category,
+                ids=ids,
+                value=str(delta),
+                kind='num',
+                expiration=expiration,
+            ))
+
+        for table, params in params_by_table.items():
+            _execute(table, _statements(table)['upsert_counter'], params)
 
-        self.delete(category, ids) # delete it if it already exists
+    def set(self, category, ids, val, time):
+        self._forget(category, ids)
 
         value, kind = self.tdb.py2db(val, True)
 
@@ -216,7 +372,7 @@ class HardCacheBackend:
 
         table = self.engine_by_category(category, "master")
 
-        _execute(table, table.insert().values(
+        _execute(table, _statements(table)['set'], dict(
             category=category,
             ids=ids,
             value=value,
@@ -226,34 +382,64 @@ class HardCacheBackend:
 
         self.profile_stop(prof)
 
-    def add(self, category, ids, val, time=0):
-        self.delete_if_expired(category, ids)
+    def set_multi(self, category, items, time):
+        """Set several ids in a category at once.
 
-        expiration = expiration_from_time(time)
+        psycopg2 sends the rows as a single multi-row upsert, so this is one
+        round trip however many there are.
+        """
+        if not items:
+            return
 
-        value, kind = self.tdb.py2db(val, True)
+        expiration = expiration_from_time(time)
 
-        prof = self.profile_start('add', category)
+        prof = self.profile_start('set_multi', category)
 
         table = self.engine_by_category(category, "master")
 
-        try:
-            _execute(table, table.insert().values(
+        params = []
+        for ids, val in items.items():
+            self._forget(category, ids)
+            value, kind = self.tdb.py2db(val, True)
+            params.append(dict(
                 category=category,
                 ids=ids,
                 value=value,
                 kind=kind,
                 expiration=expiration
             ))
-            self.profile_stop(prof)
-            return value
+        _execute(table, _statements(table)['set'], params)
+
+        self.profile_stop(prof)
+
+    def add(self, category, ids, val, time=0):
+        self._forget(category, ids)
+
+        expiration = expiration_from_time(time)
 
-        except sa.exc.IntegrityError:
-            self.profile_stop(prof)
+        value, kind = self.tdb.py2db(val, True)
+
+        prof = self.profile_start('add', category)
+
+        table = self.engine_by_category(category, "master")
+
+        added = _select(table, _statements(table)['add'], dict(
+            category=category,
+            ids=ids,
+            value=value,
+            kind=kind,
+            expiration=expiration
+        ))
+
+        self.profile_stop(prof)
+
+        if added:
+            return value
+        else:
             return self.get(category, ids, force_write_table=True)
 
     def incr(self, category, ids, time=0, delta=1):
-        self.delete_if_expired(category, ids)
+        self._forget(category, ids)
 
         expiration = expiration_from_time(time)
 
@@ -261,16 +447,12 @@ class HardCacheBackend:
 
         table = self.engine_by_category(category, "master")
 
-        stmt = table.update().where(
-            sa.and_(table.c.category==category,
-                    table.c.ids==ids,
-                    table.c.kind=='num')
-        ).values({
-            table.c.value: sa.cast(
-                sa.cast(table.c.value, sa.Integer) + delta, sa.String),
-            table.c.expiration: expiration
-        })
-        rp = _execute(table, stmt)
+        rp = _execute(table, _statements(table)['incr'], dict(
+            key_category=category,
+            key_ids=ids,
+            delta=delta,
+            new_expiration=expiration,
+        ))
 
         self.profile_stop(prof)
 
@@ -292,51 +474,77 @@ class HardCacheBackend:
             type = "master"
         else:
             type = "readslave"
+            recent = self._recall(category, ids)
+            if recent is not None:
+                _, value, kind = recent
+                return None if kind is None else self.tdb.db2py(value, kind)
 
         table = self.engine_by_category(category, type)
 
         prof = self.profile_start('get', category)
 
-        s = sa.select(table.c.value, table.c.kind, table.c.expiration).where(
-            sa.and_(table.c.category==category, table.c.ids==ids)
-        ).limit(1)
-        rows = _select(table, s)
+        rows = _select(table, _statements(table)['get'],
+                       dict(key_category=category, key_ids=ids))
 
         self.profile_stop(prof)
 
         if len(rows) < 1:
-            return None
-        elif rows[0].expiration < datetime.now(TZ):
+            if not force_write_table:
+                self._remember(category, ids)
             return None
         else:
+            if not force_write_table:
+                self._remember(category, ids, rows[0].value, rows[0].kind)
             return self.tdb.db2py(rows[0].value, rows[0].kind)
 
     def get_multi(self, category, idses):
+        results = {}
+
+        # only go to the db for keys that weren't read recently
+        missing = []
+        for ids in idses:
+            recent = self._recall(category, ids)
+            if recent is None:
+                missing.append(ids)
+            elif recent[2] is not None:
+                k = "{}-{}".format(category, ids)
+                results[k] = self.tdb.db2py(recent[1], recent[2])
+
+        if not missing:
+            return results
+        idses = missing
+
         prof = self.profile_start('get_multi', category)
 
         table = self.engine_by_category(category, "readslave")
 
-        s = sa.select(table.c.ids, table.c.value, table.c.kind, table.c.expiration).where(
-            sa.and_(table.c.category==category,
-                    sa.or_(*[table.c.ids==ids for ids in idses])))
-        rows = _select(table, s)
+        rows = []
+        # very long IN lists plan badly, so look them up in pages
+        for i in range(0, len(idses), GET_MULTI_PAGE_SIZE):
+            s = sa.select(table.c.ids, table.c.value, table.c.kind).where(
+                sa.and_(table.c.category==category,
+                        table.c.ids.in_(idses[i:i + GET_MULTI_PAGE_SIZE]),
+                        table.c.expiration >= sa.func.now()))
+            rows.extend(_select(table, s))
 
         self.profile_stop(prof)
 
-        results = {}
+        for ids in idses:
+            self._remember(category, ids)
 
-        for row in rows:
-          if row.expiration >= datetime.now(TZ):
-              k = "{}-{}".format(category, row.ids)
-              results[k] = self.tdb.db2py(row.value, row.kind)
+        for ids, value, kind in rows:
+            self._remember(category, ids, value, kind)
+            k = "{}-{}".format(category, ids)
+            results[k] = self.tdb.db2py(value, kind)
 
         return results
 
     def delete(self, category, ids):
+        self._forget(category, ids)
         prof = self.profile_start('delete', category)
         table = self.engine_by_category(category, "master")
-        _execute(table, table.delete().where(
-            sa.and_(table.c.category==category, table.c.ids==ids)))
+        _execute(table, _statements(table)['delete'],
+                 dict(key_category=category, key_ids=ids))
         self.profile_stop(prof)
 
     def ids_by_category(self, category, limit=1000):
@@ -344,7 +552,7 @@ class HardCacheBackend:
         table = self.engine_by_category(category, "readslave")
         s = sa.select(table.c.ids).where(
             sa.and_(table.c.category==category,
-                    table.c.expiration > datetime.now(TZ))
+                    table.c.expiration > sa.func.now())
         ).limit(limit)
         rows = _select(table, s)
         self.profile_stop(prof)
@@ -354,18 +562,12 @@ class HardCacheBackend:
         if expiration is None:
             return True
         elif expiration == "now":
-            return table.c.expiration < datetime.now(TZ)
+            return table.c.expiration < sa.func.now()
         else:
             return table.c.expiration < expiration
 
-    def expired(self, table, expiration_clause, limit=1000):
-        s = sa.select(table.c.category, table.c.ids, table.c.expiration).where(
-            expiration_clause
-        ).limit(limit).order_by(table.c.expiration)
-        rows = _select(table, s)
-        return [ (r.expiration, r.category, r.ids) for r in rows ]
-
     def delete_if_expired(self, category, ids, expiration="now"):
+        self._forget(category, ids)
         prof = self.profile_start('delete_if_expired', category)
         table = self.engine_by_category(category, "master")
         expiration_clause = self.clause_from_expiration(table, expiration)
@@ -389,11 +591,24 @@ def delete_expired(expiration="now", limit=5000):
     for table in masters:
         expiration_clause = backend.clause_from_expiration(table, expiration)
 
-        # Get all the expired keys
-        rows = backend.expired(table, expiration_clause, limit)
-
-        if len(rows) == 0:
+        # batching by row id relies on postgres's ctid; anything else just
+        # gets the one unbounded delete
+        if table.metadata._engine.dialect.name != 'postgresql':
+            _execute(table, table.delete().where(expiration_clause))
             continue
 
-        # Delete from the backend.
-        _execute(table, table.delete().where(expiration_clause))
+        # delete in batches of limit rows, picked by their physical row id,
+        # so no single statement holds locks on a huge number of rows. a
+        # ctid is only unique within one table, so a partitioned table is
+        # cleaned a partition at a time, which also lets each batch be
+        # fetched straight from that partition by ctid.
+        for part in _partitions(table) or [table]:
+            part_clause = backend.clause_from_expiration(part, expiration)
+            ctid = sa.literal_column('ctid')
+            expired = sa.select(ctid).select_from(part).where(
+                part_clause).limit(limit)
+            stmt = part.delete().where(
+                ctid == sa.any_(sa.func.array(expired.scalar_subquery())))
+
+            while _execute(table, stmt).rowcount >= limit:
+                pass
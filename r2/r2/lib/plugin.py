@@ -20,6 +20,7 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
+import functools
 import os.path
 import sys
 from collections import OrderedDict
@@ -27,12 +28,23 @@ from collections import OrderedDict
 from importlib.metadata import entry_points as get_entry_points, distributions
 
 
+@functools.lru_cache(maxsize=None)
+def _group_entry_points(group):
+    """Get all entry points for a group.
+
+    Finding them means reading the metadata of every installed
+    distribution, and the set doesn't change while the process runs, so
+    each group is only looked up once.
+    """
+    return tuple(get_entry_points(group=group))
+
+
 def _iter_entry_points(group, name=None):
     """Get entry points for a group, optionally filtered by name.
 
     Compatible replacement for pkg_resources working_set.iter_entry_points().
     """
-    eps = get_entry_points(group=group)
+    eps = _group_entry_points(group)
     if name is not None:
         eps = [ep for ep in eps if ep.name == name]
     return iter(eps)
@@ -113,11 +125,16 @@ class PluginLoader:
         if plugin_names is None:
             entry_points = list(self.available_plugins())
         else:
+            # the first entry point with a name wins, like next() would
+            by_name = {}
+            for entry_point in self.available_plugins():
+                by_name.setdefault(entry_point.name, entry_point)
+
             entry_points = []
             for name in plugin_names:
                 try:
-                    entry_point = next(self.available_plugins(name))
-                except StopIteration:
+                    entry_point = by_name[name]
+                except KeyError:
                     print(("Unable to locate plugin "
                                           "%s. Skipping." % name), file=sys.stderr)
                     continue
@@ -20,12 +20,14 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
-import io
+import functools
+import hashlib
 import mimetypes
 import os
 import re
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from pylons import app_globals as g
 
@@ -33,6 +35,17 @@ from r2.lib.configparse import ConfigValue
 from r2.lib.providers.media import MediaProvider
 
 _NEVER = "Thu, 31 Dec 2037 23:59:59 GMT"
+_client_config = Config(
+    max_pool_connections=64,
+    retries={'max_attempts': 3, 'mode': 'standard'},
+    tcp_keepalive=True,
+)
+_bucket_re = re.compile(r'.*\://?([^\/]+)')
+
+
+@functools.lru_cache(maxsize=4)
+def _media_domain_bucket_re(domain):
+    return re.compile(r'.*\://(?:%s.)?([^\/]+)' % re.escape(domain))
 
 
 class S3MediaProvider(MediaProvider):
@@ -75,21 +88,29 @@ class S3MediaProvider(MediaProvider):
         'previews': 's3_image_buckets',
     }
 
-    def _get_s3_client(self):
-        """Get a boto3 S3 client with configured credentials."""
+    def _get_credentials(self):
         kwargs = {}
         if g.S3KEY_ID and g.S3SECRET_KEY:
             kwargs['aws_access_key_id'] = g.S3KEY_ID
             kwargs['aws_secret_access_key'] = g.S3SECRET_KEY
-        return boto3.client('s3', **kwargs)
+        return kwargs
+
+    @functools.cached_property
+    def s3_client(self):
+        """A boto3 S3 client with configured credentials.
+
+        Clients are thread safe, so one is shared (along with its pool of
+        keep-alive connections) rather than paying for session setup and
+        a new TLS connection on every call.
+
+        """
+        return boto3.client('s3', config=_client_config,
+                            **self._get_credentials())
 
     def _get_s3_resource(self):
         """Get a boto3 S3 resource with configured credentials."""
-        kwargs = {}
-        if g.S3KEY_ID and g.S3SECRET_KEY:
-            kwargs['aws_access_key_id'] = g.S3KEY_ID
-            kwargs['aws_secret_access_key'] = g.S3SECRET_KEY
-        return boto3.resource('s3', **kwargs)
+        # resources aren't thread safe, so these aren't shared
+        return boto3.resource('s3', **self._get_credentials())
 
     def _get_bucket(self, bucket_name):
         """Get a bucket object."""
@@ -98,12 +119,12 @@ class S3MediaProvider(MediaProvider):
 
     def _get_bucket_key_from_url(self, url):
         if g.s3_media_domain in url:
-            r_bucket = re.compile(r'.*\://(?:%s.)?([^\/]+)' % g.s3_media_domain)
+            r_bucket = _media_domain_bucket_re(g.s3_media_domain)
         else:
-            r_bucket = re.compile(r'.*\://?([^\/]+)')
+            r_bucket = _bucket_re
 
-        bucket_name = r_bucket.findall(url)[0]
-        key_name = url.split('/')[-1]
+        bucket_name = r_bucket.match(url).group(1)
+        key_name = url.rpartition('/')[2]
 
         return bucket_name, key_name
 
@@ -115,7 +136,7 @@ class S3MediaProvider(MediaProvider):
         timer.start()
 
         try:
-            s3 = self._get_s3_client()
+            s3 = self.s3_client
             # Set the object ACL to private
             s3.put_object_acl(
                 Bucket=bucket_name,
@@ -132,9 +153,13 @@ class S3MediaProvider(MediaProvider):
 
     def put(self, category, name, contents, headers=None):
         buckets = getattr(g, self.buckets[category])
-        # choose a bucket based on the filename
+        # choose a bucket based on a hash of the filename. the names are
+        # mostly hex ids, so going by their last character would only ever
+        # give 16 distinct values and load the buckets unevenly
         name_without_extension = os.path.splitext(name)[0]
-        index = ord(name_without_extension[-1]) % len(buckets)
+        digest = hashlib.blake2b(
+            name_without_extension.encode('utf-8'), digest_size=8).digest()
+        index = int.from_bytes(digest, 'little') % len(buckets)
         bucket_name = buckets[index]
 
         # guess the mime type
@@ -146,6 +171,9 @@ class S3MediaProvider(MediaProvider):
             'Expires': _NEVER,
             'ACL': 'public-read',
             'StorageClass': 'REDUCED_REDUNDANCY',
+            # crc32 comes from zlib, so it's cheap; botocore can only do
+            # crc32c with the optional awscrt package installed
+            'ChecksumAlgorithm': 'CRC32',
         }
         if headers:
             # Map common header names to boto3 extra args
@@ -160,22 +188,27 @@ class S3MediaProvider(MediaProvider):
                     extra_args[header_mapping[header_name]] = value
 
         # send the key
-        s3 = self._get_s3_client()
+        s3 = self.s3_client
 
         if isinstance(contents, str):
             contents = contents.encode('utf-8')
 
-        if isinstance(contents, bytes):
-            body = io.BytesIO(contents)
+        if isinstance(contents, (bytes, bytearray)):
+            # a single PUT; upload_fileobj would go through the managed
+            # transfer thread pool even for a tiny thumbnail
+            s3.put_object(
+                Bucket=bucket_name,
+                Key=name,
+                Body=contents,
+                **extra_args
+            )
         else:
-            body = contents
-
-        s3.upload_fileobj(
-            body,
-            bucket_name,
-            name,
-            ExtraArgs=extra_args,
-        )
+            s3.upload_fileobj(
+                contents,
+                bucket_name,
+                name,
+                ExtraArgs=extra_args,
+            )
 
         if g.s3_media_direct:
             return "http://{}/{}/{}".format(g.s3_media_domain, bucket_name, name)
@@ -190,7 +223,7 @@ class S3MediaProvider(MediaProvider):
         timer.start()
 
         try:
-            s3 = self._get_s3_client()
+            s3 = self.s3_client
             s3.delete_object(Bucket=bucket_name, Key=key_name)
         except ClientError:
             # Object may not exist
@@ -22,15 +22,17 @@
 
 import base64
 import datetime
-import hashlib
+import functools
 import hmac
 import json
 import os
 import sys
 import time
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 import pytz
 from pylons import app_globals as g
@@ -38,10 +40,25 @@ from pylons import app_globals as g
 HADOOP_FOLDER_SUFFIX = '_$folder$'
 
 SIGNATURE_V4_ALGORITHM = "AWS4-HMAC-SHA256"
+_ALGORITHM_CONDITION = {"x-amz-algorithm": SIGNATURE_V4_ALGORITHM}
+
+RANGED_GET_CHUNK_SIZE = 1024 * 1024
+# botocore keeps at most 10 pooled connections per client by default
+RANGED_GET_WORKERS = 10
+
+# files over 8MB are sent as concurrent 8MB parts, one per pooled connection
+_transfer_config = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True,
+)
 
 # Cache for boto3 clients/resources
 _s3_client = None
 _s3_resource = None
+_session = None
+_credentials = None
 
 
 def _to_path(bucket, key):
@@ -60,18 +77,12 @@ def _from_path(path):
     if not path.startswith('s3://'):
         raise ValueError('Bad S3 path %s' % path)
 
-    r = path[len('s3://'):].split('/', 1)
-    bucket = key = None
-
-    if len(r) == 2:
-        bucket, key = r[0], r[1]
-    else:
-        bucket = r[0]
+    bucket, sep, key = path[len('s3://'):].partition('/')
 
     if not bucket:
         raise ValueError('Bad S3 path %s' % path)
 
-    return bucket, key
+    return bucket, key if sep else None
 
 
 S3Path = namedtuple('S3Path', ['bucket', 'key'])
@@ -111,12 +122,82 @@ def get_s3_resource():
     return _s3_resource
 
 
-def get_text_from_s3(s3_connection, path):
-    """Read a file from S3 and return it as text."""
+def _get_credentials():
+    """Return the current boto3 credentials, or None if there are none.
+
+    Resolving credentials walks the whole provider chain (environment,
+    config files, instance metadata), so that only happens once. The
+    resolved object refreshes itself when it's backed by an expiring role,
+    so each call takes a fresh frozen snapshot of it.
+
+    """
+    global _session, _credentials
+    if _session is None:
+        _session = boto3.Session()
+        _credentials = _session.get_credentials()
+    if _credentials is None:
+        return None
+    return _credentials.get_frozen_credentials()
+
+
+def get_text_from_s3(s3_connection, path, chunk_size=RANGED_GET_CHUNK_SIZE,
+                     max_workers=RANGED_GET_WORKERS):
+    """Read a file from S3 and return it as text.
+
+    The first chunk_size bytes are fetched with a ranged GET, whose
+    Content-Range gives the object's full size, so a small object still
+    takes one request. The rest of a larger object is fetched as concurrent
+    ranged GETs and assembled in place; a single GET stream tops out well
+    below what the connection can do. Every part is pinned to the first
+    response's ETag so an object overwritten mid-read fails instead of
+    being stitched together from two versions.
+
+    """
     bucket_name, key_name = _from_path(path)
-    s3 = get_s3_resource()
-    obj = s3.Object(bucket_name, key_name)
-    return obj.get()['Body'].read()
+    client = get_s3_client()
+    try:
+        first = client.get_object(
+            Bucket=bucket_name,
+            Key=key_name,
+            Range='bytes=0-{}'.format(chunk_size - 1),
+        )
+    except ClientError as e:
+        # an empty object has no byte 0 to start the range at
+        if e.response.get('Error', {}).get('Code') != 'InvalidRange':
+            raise
+        response = client.get_object(Bucket=bucket_name, Key=key_name)
+        return response['Body'].read()
+
+    head = first['Body'].read()
+    content_range = first.get('ContentRange')
+    if not content_range:
+        # the range was ignored and the whole object came back
+        return head
+    size = int(content_range.rpartition('/')[2])
+    if size <= len(head):
+        return head
+
+    etag = first['ETag']
+    result = bytearray(size)
+    result[:len(head)] = head
+
+    def fetch_range(lo):
+        hi = min(lo + chunk_size, size) - 1
+        response = client.get_object(
+            Bucket=bucket_name,
+            Key=key_name,
+            Range='bytes={}-{}'.format(lo, hi),
+            IfMatch=etag,
+        )
+        result[lo:hi + 1] = response['Body'].read()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fetch_range, lo)
+                   for lo in range(len(head), size, chunk_size)]
+        for future in futures:
+            future.result()
+
+    return bytes(result)
 
 
 def mv_file_s3(s3_connection, src_path, dst_path):
@@ -153,7 +234,8 @@ def copy_to_s3(s3_connection, local_path, dst_path, verbose=False):
         print('Uploading {} to {}'.format(local_path, dst_path))
 
     s3 = get_s3_resource()
-    s3.Object(dst_bucket_name, key_name).upload_file(local_path)
+    s3.Object(dst_bucket_name, key_name).upload_file(
+        local_path, Config=_transfer_config)
 
 
 def get_connection():
@@ -161,35 +243,85 @@ def get_connection():
     return get_s3_resource()
 
 
-def get_key(bucket_name, key, connection=None):
+def get_key(bucket_name, key, connection=None, check_exists=False):
+    """Return an Object for the key.
+
+    The object's metadata is loaded lazily on first access, so no request
+    is made unless check_exists is set, in which case None is returned for
+    a missing key.
+
+    """
     s3 = get_s3_resource()
     obj = s3.Object(bucket_name, key)
-    try:
-        obj.load()
-        return obj
-    except ClientError:
-        return None
+    if check_exists:
+        try:
+            obj.load()
+        except ClientError:
+            return None
+    return obj
 
 
-def get_keys(bucket_name, meta=False, connection=None, prefix='', **kwargs):
-    s3 = get_s3_resource()
-    bucket = s3.Bucket(bucket_name)
-    objects = list(bucket.objects.filter(Prefix=prefix))
+def _iter_key_pages(bucket_name, prefix=''):
+    """Yield the listed objects under a prefix, a page (up to 1000) at a time.
+
+    This uses the client's list_objects_v2 paginator directly rather than
+    going through a resource collection, which wraps every object. Each
+    page is the list of Contents entries from the response.
+
+    """
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        contents = page.get('Contents')
+        if contents:
+            yield contents
+
+
+def _make_object_summary(s3, bucket_name, entry):
+    """Build an ObjectSummary carrying its listing data.
+
+    ObjectSummary has no load(), so without the listing entry as its
+    meta.data, size, last_modified and e_tag could not be read.
+
+    """
+    summary = s3.ObjectSummary(bucket_name, entry['Key'])
+    summary.meta.data = entry
+    return summary
 
-    if not meta:
-        return objects
 
-    return [s3.Object(bucket_name, obj.key) for obj in objects]
+def get_keys(bucket_name, meta=False, connection=None, prefix='', **kwargs):
+    s3 = get_s3_resource()
+    if meta:
+        return [s3.Object(bucket_name, entry['Key'])
+                for entries in _iter_key_pages(bucket_name, prefix)
+                for entry in entries]
+    return [_make_object_summary(s3, bucket_name, entry)
+            for entries in _iter_key_pages(bucket_name, prefix)
+            for entry in entries]
 
 
-def delete_keys(bucket_name, prefix, connection=None):
+def delete_keys(bucket_name, prefix, connection=None, max_workers=8):
     s3 = get_s3_resource()
-    bucket = s3.Bucket(bucket_name)
-    objects = list(bucket.objects.filter(Prefix=prefix))
-    if objects:
-        bucket.delete_objects(
-            Delete={'Objects': [{'Key': obj.key} for obj in objects]}
+    client = get_s3_client()
+    objects = []
+
+    def delete_page(entries):
+        client.delete_objects(
+            Bucket=bucket_name,
+            Delete={'Objects': [{'Key': entry['Key']} for entry in entries]},
         )
+
+    # listing has to follow continuation tokens one page at a time, but
+    # each page's deletion can run while the next page is being fetched.
+    # a page is never more than the 1000 keys delete_objects allows.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for entries in _iter_key_pages(bucket_name, prefix):
+            futures.append(executor.submit(delete_page, entries))
+            objects.extend(_make_object_summary(s3, bucket_name, entry)
+                           for entry in entries)
+        for future in futures:
+            future.result()
+
     return objects
 
 
@@ -218,25 +350,24 @@ def _get_upload_policy(
     meta = meta or {}
 
     expiration = time.gmtime(int(time.time() + ttl))
-    conditions = []
-
-    conditions.append({"bucket": bucket})
 
     if key.endswith("${filename}"):
-        conditions.append(["starts-with", "$key", key[:-len("${filename}")]])
+        key_condition = ["starts-with", "$key", key[:-len("${filename}")]]
     else:
-        conditions.append({"key": key})
-
-    conditions.append({"acl": acl})
-    conditions.append({"x-amz-storage-class": storage_class})
-
-    conditions.append({"x-amz-credential": credential})
-    conditions.append({"x-amz-algorithm": SIGNATURE_V4_ALGORITHM})
-    conditions.append({"x-amz-date": date.strftime("%Y%m%dT%H%M%SZ")})
+        key_condition = {"key": key}
+
+    conditions = [
+        {"bucket": bucket},
+        key_condition,
+        {"acl": acl},
+        {"x-amz-storage-class": storage_class},
+        {"x-amz-credential": credential},
+        _ALGORITHM_CONDITION,
+        {"x-amz-date": date.strftime("%Y%m%dT%H%M%SZ")},
+    ]
 
     # Get security token from session if available
-    session = boto3.Session()
-    credentials = session.get_credentials()
+    credentials = _get_credentials()
     if credentials and credentials.token:
         conditions.append({"x-amz-security-token": credentials.token})
 
@@ -262,18 +393,22 @@ def _get_upload_policy(
 
     # ISO8601 format for policy expiration
     iso8601_format = "%Y-%m-%dT%H:%M:%SZ"
+    # the policy is signed as-is, so don't pad it with whitespace. json
+    # escapes everything outside ascii, so the encoding is a plain copy.
     return base64.b64encode(json.dumps({
         "expiration": time.strftime(iso8601_format, expiration),
         "conditions": conditions,
-    }).encode('utf-8'))
+    }, separators=(',', ':')).encode('ascii'))
 
 
 def _sign(secret, msg):
-    return hmac.new(secret, msg.encode("utf-8"), hashlib.sha256).digest()
+    return hmac.digest(secret, msg.encode("utf-8"), "sha256")
 
 
-def _derive_v4_signature_key(secret, date, region_name, service_name):
-    key_date = _sign(("AWS4" + secret).encode("utf-8"), date.strftime("%Y%m%d"))
+@functools.lru_cache(maxsize=8)
+def _derive_v4_signature_key(secret, datestamp, region_name, service_name):
+    # the key only changes daily, so it's derived once per day and region
+    key_date = _sign(("AWS4" + secret).encode("utf-8"), datestamp)
     key_region = _sign(key_date, region_name)
     key_service = _sign(key_region, service_name)
     return _sign(key_service, "aws4_request")
@@ -286,18 +421,16 @@ def _get_upload_signature(
         connection=None,
     ):
 
-    session = boto3.Session()
-    credentials = session.get_credentials()
+    credentials = _get_credentials()
     if credentials:
         secret_key = credentials.secret_key
     else:
         secret_key = g.S3SECRET_KEY
 
-    key = secret_key.encode("utf-8") if isinstance(secret_key, str) else secret_key
     v4_key = _derive_v4_signature_key(
-        secret=secret_key, date=date, region_name=region_name, service_name="s3")
+        secret_key, date.strftime("%Y%m%d"), region_name, "s3")
 
-    return hmac.new(v4_key, policy, hashlib.sha256).hexdigest()
+    return hmac.digest(v4_key, policy, "sha256").hex()
 
 
 def get_post_args(
@@ -317,8 +450,7 @@ def get_post_args(
     algorithm = "AWS4-HMAC-SHA256"
     date = datetime.datetime.now(pytz.utc)
 
-    session = boto3.Session()
-    credentials = session.get_credentials()
+    credentials = _get_credentials()
     if credentials:
         access_key = credentials.access_key
         security_token = credentials.token
@@ -409,7 +541,7 @@ def get_post_args(
 
     fields.append({
         "name": "policy",
-        "value": policy.decode('utf-8') if isinstance(policy, bytes) else policy,
+        "value": policy.decode('ascii'),
     })
 
     fields.append({
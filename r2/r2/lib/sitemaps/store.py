@@ -43,7 +43,9 @@ have to load all of the subreddits into memory, which would be ... bad.
 
 
 import gzip
-from io import BytesIO
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 from pylons import app_globals as g
@@ -52,17 +54,29 @@ from r2.lib.sitemaps.generate import sitemap_index, subreddit_sitemaps
 
 CONTENT_TYPE = 'text/xml'
 CONTENT_ENCODING = 'gzip'
+# sitemap xml is very repetitive, so higher levels cost a lot more cpu for
+# barely smaller files
+COMPRESS_LEVEL = 6
+# wbits for zlib to write a gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+ENCODE_CHUNK_SIZE = 64 * 1024
+# s3 puts are latency bound, and throughput levels off around 16 at once
+UPLOAD_WORKERS = 16
 
 
 def zip_string(string):
     """Compress a string using gzip."""
-    zipbuffer = BytesIO()
-    # Ensure string is bytes
-    if isinstance(string, str):
-        string = string.encode('utf-8')
-    with gzip.GzipFile(mode='wb', fileobj=zipbuffer) as f:
-        f.write(string)
-    return zipbuffer.getvalue()
+    if not isinstance(string, str):
+        return gzip.compress(string, compresslevel=COMPRESS_LEVEL)
+
+    # encode and compress a chunk at a time rather than making a full utf-8
+    # copy of the sitemap first, so only the compressed copy is held
+    # alongside the original
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+    parts = [compressor.compress(string[i:i + ENCODE_CHUNK_SIZE].encode('utf-8'))
+             for i in range(0, len(string), ENCODE_CHUNK_SIZE)]
+    parts.append(compressor.flush())
+    return b''.join(parts)
 
 
 def upload_sitemap(s3_client, bucket_name, key_name, sitemap):
@@ -76,10 +90,21 @@ def upload_sitemap(s3_client, bucket_name, key_name, sitemap):
     )
 
 
-def store_subreddit_sitemap(s3_client, bucket_name, index, sitemap):
+def store_subreddit_sitemap(s3_client, bucket_name, index, sitemap,
+                            executor=None):
+    """Upload a subreddit sitemap, on executor if one is given.
+
+    Returns the upload's future when run on an executor. The logging
+    happens here rather than in the upload since pylons globals aren't
+    available in the executor's threads.
+    """
     key_name = 'subreddit_sitemap/{}.xml'.format(index)
     g.log.debug("Uploading %s/%s", bucket_name, key_name)
-    upload_sitemap(s3_client, bucket_name, key_name, sitemap)
+    if executor is None:
+        upload_sitemap(s3_client, bucket_name, key_name, sitemap)
+    else:
+        return executor.submit(
+            upload_sitemap, s3_client, bucket_name, key_name, sitemap)
 
 
 def store_sitemap_index(s3_client, bucket_name, count):
@@ -93,8 +118,18 @@ def store_sitemaps_in_s3(subreddits):
     bucket_name = g.sitemap_upload_s3_bucket
 
     sitemap_count = 0
-    for i, sitemap in enumerate(subreddit_sitemaps(subreddits)):
-        store_subreddit_sitemap(s3_client, bucket_name, i, sitemap)
-        sitemap_count += 1
+    # upload in parallel, but only let a bounded number of sitemaps wait
+    # for upload so they aren't all held in memory at once
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        pending = deque()
+        for i, sitemap in enumerate(subreddit_sitemaps(subreddits)):
+            pending.append(store_subreddit_sitemap(
+                s3_client, bucket_name, i, sitemap, executor=executor))
+            if len(pending) >= UPLOAD_WORKERS * 2:
+                pending.popleft().result()
+            sitemap_count += 1
+
+        for future in pending:
+            future.result()
 
     store_sitemap_index(s3_client, bucket_name, sitemap_count)
@@ -21,8 +21,10 @@
 ###############################################################################
 """Pure Python fallback for _utils.pyx (used when Cython module is not compiled)."""
 
+import functools
 import re
 from datetime import datetime, timedelta
+from itertools import chain
 
 from pylons.i18n import _, ungettext
 
@@ -34,40 +36,37 @@ def to_base(q, alphabet):
     converted = []
     while q != 0:
         q, r = divmod(q, l)
-        converted.insert(0, alphabet[r])
+        converted.append(alphabet[r])
+    converted.reverse()
     return "".join(converted) or '0'
 
 
+# ids recur heavily within and across listings
+@functools.lru_cache(maxsize=65536)
 def to36(q):
     return to_base(q, '0123456789abcdefghijklmnopqrstuvwxyz')
 
 
+_iterable_types = (list, tuple, set, frozenset, dict)
+
+
 def tup(item, ret_is_single=False):
     """Forces casting of item to a tuple (for a list) or generates a
     single element tuple (for anything else)"""
-    # return true for iterables, except for strings, which is what we want
-    if hasattr(item, '__iter__') and not isinstance(item, (str, bytes)):
+    # return true for iterables, except for strings, which is what we want.
+    # the common containers are checked first to skip the hasattr lookup.
+    if (isinstance(item, _iterable_types) or
+            (hasattr(item, '__iter__') and not isinstance(item, (str, bytes)))):
         return (item, False) if ret_is_single else item
     else:
         return ((item,), True) if ret_is_single else (item,)
 
 
-def _strips(direction, text, remove):
-    # Normalize bytes to text for safe startswith/endswith comparisons.
-    if isinstance(text, bytes):
-        text = text.decode('latin-1')
-    if isinstance(remove, bytes):
-        remove = remove.decode('latin-1')
-
-    if direction == 'l':
-        if text.startswith(remove):
-            return text[len(remove):]
-    elif direction == 'r':
-        if text.endswith(remove):
-            return text[:-len(remove)]
-    else:
-        raise ValueError("Direction needs to be r or l.")
-    return text
+def _text(s):
+    # bytes are treated as latin-1 so any byte string round-trips
+    if isinstance(s, bytes):
+        return s.decode('latin-1')
+    return s
 
 
 def rstrips(text, remove):
@@ -78,7 +77,9 @@ def rstrips(text, remove):
         'foo'
 
     """
-    return _strips('r', text, remove)
+    if text.__class__ is not str or remove.__class__ is not str:
+        text, remove = _text(text), _text(remove)
+    return text.removesuffix(remove)
 
 
 def lstrips(text, remove):
@@ -89,7 +90,9 @@ def lstrips(text, remove):
         'bar'
 
     """
-    return _strips('l', text, remove)
+    if text.__class__ is not str or remove.__class__ is not str:
+        text, remove = _text(text), _text(remove)
+    return text.removeprefix(remove)
 
 
 def strips(text, remove):
@@ -102,19 +105,16 @@ def strips(text, remove):
     return rstrips(lstrips(text, remove), remove)
 
 
-ESCAPE = re.compile(r'[\x00-\x19\\"\b\f\n\r\t]')
-ESCAPE_ASCII = re.compile(r'([\\"/]|[^\ -~])')
+ESCAPE_CONTROL = re.compile(r'[\x00-\x1f]')
 ESCAPE_DCT = {
-    # escape all forward slashes to prevent </script> attack
-    '/': '\\/',
-    '\\': '\\\\',
-    '"': '\\"',
     '\b': '\\b',
     '\f': '\\f',
     '\n': '\\n',
     '\r': '\\r',
     '\t': '\\t',
 }
+ESCAPE_DCT.update((chr(i), '\\u%04x' % i)
+                  for i in range(0x20) if chr(i) not in ESCAPE_DCT)
 
 
 def _string2js_replace(match):
@@ -123,13 +123,17 @@ def _string2js_replace(match):
 
 def string2js(s):
     """adapted from http://svn.red-bean.com/bob/simplejson/trunk/simplejson/encoder.py"""
-    for i in range(20):
-        ESCAPE_DCT.setdefault(chr(i), '\\u%04x' % (i,))
-
     if isinstance(s, bytes):
         s = s.decode('latin-1')
 
-    return '"' + ESCAPE.sub(_string2js_replace, s) + '"'
+    # escape all forward slashes to prevent </script> attack. the common
+    # characters go through str.replace, which runs in C; control
+    # characters are rare enough that a regex pass is only made for them
+    # when there are any.
+    s = s.replace('\\', '\\\\').replace('"', '\\"').replace('/', '\\/')
+    if ESCAPE_CONTROL.search(s) is not None:
+        s = ESCAPE_CONTROL.sub(_string2js_replace, s)
+    return '"' + s + '"'
 
 
 def timeago(interval):
@@ -165,6 +169,7 @@ timeintervald = dict(
 )
 
 
+@functools.lru_cache(maxsize=512)
 def timeinterval_fromstr(interval):
     "Used by timeago and timefromnow to generate timedeltas from friendly text"
     parts = interval.strip().split(' ')
@@ -176,7 +181,8 @@ def timeinterval_fromstr(interval):
         num = int(num)
     else:
         raise ValueError('format should be ([num] second|minute|etc)')
-    period = rstrips(period, 's')
+    if period.endswith('s'):
+        period = period[:-1]
 
     d = timeintervald[period]
     delta = num * d
@@ -296,10 +302,7 @@ def prefix_keys(keys, prefix, callfn):
 
 def flatten(lists):
     """[[1,2], [3], [4,5,6]] -> [1,2,3,4,5,6]"""
-    ret = []
-    for l in lists:
-        ret.extend(l)
-    return ret
+    return list(chain.from_iterable(lists))
 
 
 def _l(l):
@@ -318,11 +321,11 @@ def get_after(fullnames, fullname, num, reverse=False):
     if not fullname:
         return fullnames[:num]
 
-    for i, item in enumerate(fullnames):
-        if item == fullname:
-            return fullnames[i + 1:i + num + 1]
-
-    return fullnames[:num]
+    try:
+        i = fullnames.index(fullname)
+    except ValueError:
+        return fullnames[:num]
+    return fullnames[i + 1:i + num + 1]
 
 
 __all__ = [
@@ -23,19 +23,26 @@
 # Pure Python fallback for comment_tree_utils.pyx
 # This provides the same functionality without requiring Cython compilation.
 
+from collections import deque
 
-def _sort_key_none_first(x):
-    """Sort key that puts None first, then sorts numerically."""
-    if x is None:
-        return (0, 0)
-    return (1, x)
 
+def _walk_tree(tree, roots, cids, depth, parents):
+    """Walk tree breadth first from roots, whose depths must be set."""
+    get_children = tree.get
+    queue = deque(roots)
+    while queue:
+        parent_id = queue.popleft()
+        child_ids = get_children(parent_id)
+        if not child_ids:
+            continue
 
-def _sort_key_none_last(x):
-    """Sort key that puts None last, then sorts numerically."""
-    if x is None:
-        return (1, 0)
-    return (0, x)
+        cids.extend(child_ids)
+        child_depth = depth[parent_id] + 1
+        for child_id in child_ids:
+            parents[child_id] = parent_id
+            depth[child_id] = child_depth
+            if child_id in tree:
+                queue.append(child_id)
 
 
 def get_tree_details(tree):
@@ -51,18 +58,26 @@ def get_tree_details(tree):
             parents: dict mapping comment_id -> parent_id
     """
     cids = []
-    depth = {}
+    depth = {None: -1}
     parents = {}
 
-    for parent_id in sorted(tree, key=_sort_key_none_first):
-        child_ids = tree[parent_id]
-
-        cids.extend(child_ids)
-
-        parents.update({child_id: parent_id for child_id in child_ids})
-
-        child_depth = depth.get(parent_id, -1) + 1
-        depth.update({child_id: child_depth for child_id in child_ids})
+    _walk_tree(tree, [None], cids, depth, parents)
+    del depth[None]
+
+    if len(cids) < sum(map(len, tree.values())):
+        # comments can be added to the tree before their parent (see
+        # CommentTreePermacache.add_comments). walk those from their own
+        # roots so they still get listed, at depth 0.
+        orphaned = [parent_id for parent_id in tree
+                    if parent_id is not None and parent_id not in depth]
+        children = {child_id for parent_id in orphaned
+                    for child_id in tree[parent_id]}
+        roots = [parent_id for parent_id in orphaned
+                 if parent_id not in children]
+        depth.update(dict.fromkeys(roots, -1))
+        _walk_tree(tree, roots, cids, depth, parents)
+        for parent_id in roots:
+            del depth[parent_id]
 
     return cids, depth, parents
 
@@ -78,11 +93,24 @@ def calc_num_children(tree):
     """
     num_children = {}
 
-    for parent_id in sorted(tree, key=_sort_key_none_last, reverse=True):
-        if parent_id is None:
+    # count each subtree after all of its children's subtrees (a post-order
+    # walk), so this doesn't depend on children having larger ids
+    for root_id in tree:
+        if root_id is None or root_id in num_children:
             continue
 
-        child_ids = tree[parent_id]
-        num_children[parent_id] = sum(
-            1 + num_children.get(child_id, 0) for child_id in tree[parent_id])
+        stack = [root_id]
+        while stack:
+            parent_id = stack[-1]
+            child_ids = tree[parent_id]
+            pending = [child_id for child_id in child_ids
+                       if child_id in tree and child_id not in num_children]
+            if pending:
+                stack.extend(pending)
+                continue
+
+            stack.pop()
+            num_children[parent_id] = len(child_ids) + sum(
+                num_children[child_id] for child_id in child_ids
+                if child_id in num_children)
     return num_children
@@ -21,22 +21,55 @@
 ###############################################################################
 
 
-def get_tree_details(dict tree):
+from collections import deque
+
+
+cdef _walk_tree(dict tree, list roots, list cids, dict depth, dict parents):
+    """Walk tree breadth first from roots, whose depths must be set."""
     cdef:
-        list cids = []
-        dict depth = {}
-        dict parents = {}
         list child_ids
+        long child_depth
 
-    for parent_id in sorted(tree):
-        child_ids = tree[parent_id]
+    queue = deque(roots)
+    while queue:
+        parent_id = queue.popleft()
+        child_ids = tree.get(parent_id)
+        if not child_ids:
+            continue
 
         cids.extend(child_ids)
+        child_depth = depth[parent_id] + 1
+        for child_id in child_ids:
+            parents[child_id] = parent_id
+            depth[child_id] = child_depth
+            if child_id in tree:
+                queue.append(child_id)
+
 
-        parents.update({child_id: parent_id for child_id in child_ids})
+def get_tree_details(dict tree):
+    cdef:
+        list cids = []
+        dict depth = {None: -1}
+        dict parents = {}
+        list orphaned, roots
 
-        child_depth = depth.get(parent_id, -1) + 1
-        depth.update({child_id: child_depth for child_id in child_ids})
+    _walk_tree(tree, [None], cids, depth, parents)
+    del depth[None]
+
+    if len(cids) < sum(map(len, tree.values())):
+        # comments can be added to the tree before their parent (see
+        # CommentTreePermacache.add_comments). walk those from their own
+        # roots so they still get listed, at depth 0.
+        orphaned = [parent_id for parent_id in tree
+                    if parent_id is not None and parent_id not in depth]
+        children = {child_id for parent_id in orphaned
+                    for child_id in tree[parent_id]}
+        roots = [parent_id for parent_id in orphaned
+                 if parent_id not in children]
+        depth.update(dict.fromkeys(roots, -1))
+        _walk_tree(tree, roots, cids, depth, parents)
+        for parent_id in roots:
+            del depth[parent_id]
 
     return cids, depth, parents
 
@@ -44,13 +77,26 @@ def get_tree_details(dict tree):
 def calc_num_children(dict tree):
     cdef:
         dict num_children = {}
-        list child_ids
+        list stack, child_ids, pending
 
-    for parent_id in sorted(tree, reverse=True):
-        if parent_id is None:
+    # count each subtree after all of its children's subtrees (a post-order
+    # walk), so this doesn't depend on children having larger ids
+    for root_id in tree:
+        if root_id is None or root_id in num_children:
             continue
 
-        child_ids = tree[parent_id]
-        num_children[parent_id] = sum(
-            1 + num_children.get(child_id, 0) for child_id in tree[parent_id])
+        stack = [root_id]
+        while stack:
+            parent_id = stack[-1]
+            child_ids = tree[parent_id]
+            pending = [child_id for child_id in child_ids
+                       if child_id in tree and child_id not in num_children]
+            if pending:
+                stack.extend(pending)
+                continue
+
+            stack.pop()
+            num_children[parent_id] = len(child_ids) + sum(
+                num_children[child_id] for child_id in child_ids
+                if child_id in num_children)
     return num_children
@@ -20,7 +20,10 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
+import functools
 import re
+import sys
+from dataclasses import dataclass
 
 from httpagentparser import AndroidBrowser, Browser, DetectorBase, detectorshub
 from httpagentparser import detect as de
@@ -34,9 +37,13 @@ def register_detector(cls):
 
 class RedditDetectorBase(DetectorBase):
     agent_string = None
-    version_string = r'(\.?\d+)*'
+    # the same strings as (\.?\d+)*, but written so that a run of digits can
+    # only be split up one way. the nested form backtracks exponentially
+    # when a long run of digits is followed by something that doesn't match.
+    version_string = r'(?:\.?\d+(?:\.\d+)*)?'
 
     def __init__(self):
+        super().__init__()
         if self.agent_string:
             self.agent_regex = re.compile(self.agent_string.format(
                 look_for=self.look_for, version_string=self.version_string))
@@ -47,15 +54,14 @@ class RedditDetectorBase(DetectorBase):
             self.version_string))
 
     def getVersion(self, agent, word):
-        match = None
+        # the base detect() only gets here once checkWords has found
+        # look_for in the agent. detect() below takes the version from the
+        # same agent_regex match it reads the platform from, rather than
+        # running the regex twice.
         if self.agent_regex:
-            match = self.agent_regex.search(agent)
+            return None
 
-        if not match:
-            match = self.version_regex.search(agent)
-
-        if match and 'version' in list(match.groupdict().keys()):
-            return match.group('version')
+        return self.version_regex.search(agent).group('version')
 
     def detect(self, agent, result):
         detected = super().detect(agent, result)
@@ -64,7 +70,17 @@ class RedditDetectorBase(DetectorBase):
             return detected
 
         match = self.agent_regex.search(agent)
+        if not match:
+            version = self.version_regex.search(agent).group('version')
+            if version:
+                result[self.info_type]['version'] = version
+            return detected
+
         groups = match.groupdict()
+        version = groups.get('version')
+        if version:
+            result[self.info_type]['version'] = version
+
         platform_name = groups.get('platform')
         version = groups.get('pversion')
 
@@ -184,31 +200,37 @@ def detect(*args, **kw):
     return de(*args, **kw)
 
 
-class Agent:
-    __slots__ = (
-        "agent_string",
-        "browser_name",
-        "browser_version",
-        "os_name",
-        "os_version",
-        "platform_name",
-        "platform_version",
-        "sub_platform_name",
-        "bot",
-        "app_name",
-        "is_mobile_browser",
-    )
-
-    MOBILE_PLATFORMS = {'iOS', 'Windows', 'Android', 'BlackBerry'}
-
-    def __init__(self, **kw):
-        kw.setdefault("is_mobile_browser", False)
-        for k in self.__slots__:
-            setattr(self, k, kw.get(k))
+_interned_fields = (
+    "browser_name",
+    "os_name",
+    "platform_name",
+    "sub_platform_name",
+    "app_name",
+)
 
+
+@dataclass(frozen=True, slots=True)
+class Agent:
+    agent_string: str = None
+    browser_name: str = None
+    browser_version: str = None
+    os_name: str = None
+    os_version: str = None
+    platform_name: str = None
+    platform_version: str = None
+    sub_platform_name: str = None
+    bot: bool = None
+    app_name: str = None
+    is_mobile_browser: bool = False
+
+    MOBILE_PLATFORMS = frozenset({'iOS', 'Windows', 'Android', 'BlackBerry'})
+
+    # agents are immutable, so the cached instance is shared between all the
+    # requests with the same user agent
     @classmethod
+    @functools.lru_cache(maxsize=16384)
     def parse(cls, ua):
-        agent = cls(agent_string=ua)
+        fields = {"agent_string": ua}
         parsed = detect(ua)
         for attr in ("browser", "os", "platform"):
             d = parsed.get(attr)
@@ -216,16 +238,26 @@ class Agent:
                 for subattr in ("name", "version"):
                     if subattr in d:
                         key = "{}_{}".format(attr, subattr)
-                        setattr(agent, key, d[subattr])
+                        fields[key] = d[subattr]
 
-        agent.bot = parsed.get('bot')
+        fields["bot"] = parsed.get('bot')
         dist = parsed.get('dist')
         if dist:
-            agent.sub_platform_name = dist.get('name')
+            fields["sub_platform_name"] = dist.get('name')
 
         # if this is a known app, extract the app_name
-        agent.app_name = parsed.get('app_name')
-        agent.is_mobile_browser = agent.determine_mobile_browser()
+        fields["app_name"] = parsed.get('app_name')
+
+        # the names come from a small set, so share one copy of each
+        for key in _interned_fields:
+            value = fields.get(key)
+            if value.__class__ is str:
+                fields[key] = sys.intern(value)
+
+        agent = cls(**fields)
+        # set after the fact, since the check reads the other fields
+        object.__setattr__(
+            agent, "is_mobile_browser", agent.determine_mobile_browser())
         return agent
 
     def determine_mobile_browser(self):
@@ -236,8 +268,8 @@ class Agent:
             if (
                 self.platform_name == 'Android' and
                 not (
-                    'Mobile' in self.agent_string or
-                    self.browser_name == 'Opera Mobile'
+                    self.browser_name == 'Opera Mobile' or
+                    'Mobile' in self.agent_string
                 )
             ):
                 return False
@@ -127,10 +127,33 @@ class class_property:
 
 
 class Results():
-    def __init__(self, sa_ResultProxy, build_fn, do_batch=False):
+    """Wrap a result proxy, building objects from its rows as they're fetched.
+
+    If a connection is passed (for streamed results) it is closed once the
+    rows run out, or when close() is called / the with block exits.
+
+    """
+
+    def __init__(self, sa_ResultProxy, build_fn, do_batch=False,
+                 connection=None):
         self.rp = sa_ResultProxy
         self.fn = build_fn
         self.do_batch = do_batch
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.rp.close()
+            finally:
+                self.connection.close()
+                self.connection = None
 
     @property
     def rowcount(self):
@@ -143,13 +166,18 @@ class Results():
             return [self.fn(row) for row in res]
 
     def fetchall(self):
-        return self._fetch(self.rp.fetchall())
+        try:
+            rows = self.rp.fetchall()
+        finally:
+            self.close()
+        return self._fetch(rows)
 
     def fetchmany(self, n):
         rows = self._fetch(self.rp.fetchmany(n))
         if rows:
             return rows
         else:
+            self.close()
             raise StopIteration
 
     def fetchone(self):
@@ -164,6 +192,7 @@ class Results():
             else:
                 return self.fn(row)
         else:
+            self.close()
             raise StopIteration
 
 r_base_url = re.compile("(?i)(?:.+?://)?([^#]*[^#/])/?")
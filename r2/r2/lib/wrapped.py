@@ -6,11 +6,16 @@ and for basic rendering paths. It intentionally implements a subset of
 the original behaviour to avoid requiring C compilation in test CI.
 """
 from datetime import datetime
-from hashlib import md5
+import functools
+from hashlib import blake2b
 import random
 import re
 import types
 
+from pylons import app_globals as g
+from pylons import request
+from pylons import tmpl_context as c
+
 from r2.lib.utils import SimpleSillyStub
 
 CACHE_HIT_SAMPLE_RATE = 0.001
@@ -27,11 +32,15 @@ class _TemplateUpdater:
         self.pattern = pattern
 
     def update(self):
-        return self.pattern.sub(self._convert, self.template)
-
-    def _convert(self, m):
-        name = m.group("named")
-        return self.d.get(name, self.start + name + self.end)
+        # the pattern has a single group, so split() puts the names at the
+        # odd indexes. filling those in and joining is about twice as fast
+        # as sub() with a callback per name.
+        parts = self.pattern.split(self.template)
+        get = self.d.get
+        for i in range(1, len(parts), 2):
+            name = parts[i]
+            parts[i] = get(name, self.start + name + self.end)
+        return ''.join(parts)
 
 
 class StringTemplate:
@@ -52,27 +61,73 @@ class StringTemplate:
         else:
             self.template = str(template)
 
+    def _substitute(self, d):
+        # most rendered leaves have no variables in them at all, and a
+        # substring check is much cheaper than letting the regex scan
+        if not d or self.start_delim not in self.template:
+            return None
+        updater = _TemplateUpdater(d, self.start_delim, self.end_delim,
+                                   self.template, self.pattern2)
+        return updater.update()
+
     def update(self, d):
         """Replace variables in the template and return an updated Template."""
-        if d:
-            updater = _TemplateUpdater(d, self.start_delim, self.end_delim,
-                                       self.template, self.pattern2)
-            return self.__class__(updater.update())
-        return self
+        template = self._substitute(d)
+        if template is None:
+            return self
+        return self.__class__(template)
 
     def finalize(self, d=None):
         """Same as update but returns the final string."""
-        if d:
-            return self.update(d).template
-        return self.template
+        template = self._substitute(d)
+        if template is None:
+            return self.template
+        return template
+
+    def resolve(self, d):
+        """Replace variables until none from d are left; return the string.
+
+        Values can contain further variables, which are resolved the same
+        way. Each value is resolved once however many times it's used, and
+        a variable found inside its own value is left in place.
+
+        """
+        start, end = self.start_delim, self.end_delim
+        split = self.pattern2.split
+        resolved = {}
+        pending = set()
+
+        def _resolve(template):
+            if start not in template:
+                return template
+            parts = split(template)
+            for i in range(1, len(parts), 2):
+                name = parts[i]
+                if name in resolved:
+                    parts[i] = resolved[name]
+                elif name in d and name not in pending:
+                    pending.add(name)
+                    parts[i] = resolved[name] = _resolve(d[name])
+                    pending.discard(name)
+                else:
+                    parts[i] = start + name + end
+            return ''.join(parts)
+
+        return _resolve(self.template)
 
 
 class CacheStub:
     def __init__(self, item, style):
-        self.name = "h%s%s" % (id(item), str(style).replace('-', '_'))
+        self._set_name("h%s%s" % (id(item), str(style).replace('-', '_')))
+
+    def _set_name(self, name):
+        # the stub is embedded in the output every time it's rendered, so
+        # it's built once up front
+        self.name = name
+        self._stub = StringTemplate.start_delim + name + StringTemplate.end_delim
 
     def __str__(self):
-        return StringTemplate.start_delim + self.name + StringTemplate.end_delim
+        return self._stub
 
     def __repr__(self):
         return "<%s: %s>" % (self.__class__.__name__, self.name)
@@ -80,7 +135,7 @@ class CacheStub:
 
 class CachedVariable(CacheStub):
     def __init__(self, name):
-        self.name = name
+        self._set_name(name)
 
 
 class Templated(object):
@@ -113,9 +168,6 @@ class Templated(object):
 
     def render_nocache(self, style):
         """No-frills rendering of the template."""
-        from pylons import tmpl_context as c
-        from pylons import app_globals as g
-
         if (self.cachable and
                 style != "api" and
                 random.random() < RENDER_TIMER_SAMPLE_RATE):
@@ -146,9 +198,6 @@ class Templated(object):
         cachable templates, insert stubs for them in the output,
         get_multi from the cache, and render the uncached templates.
         """
-        from pylons import tmpl_context as c
-        from pylons import app_globals as g
-
         style = style or getattr(c, 'render_style', None) or 'html'
 
         # prepare (and store) the list of cachable items
@@ -221,16 +270,10 @@ class Templated(object):
                 _updates[k] = v.finalize(kw)
             updates = _updates
 
-            # replace till we can't replace any more
-            npasses = 0
-            while True:
-                npasses += 1
-                r = res
-                res = res.update(kwargs).update(updates)
-                semi_final = res.finalize()
-                if r.finalize() == res.finalize():
-                    res = semi_final
-                    break
+            # replace till we can't replace any more. stub names are made
+            # from ids so they can't collide with the kwargs.
+            updates.update(kwargs)
+            res = res.resolve(updates)
 
             # wipe out the render tracker object
             c.render_tracker = None
@@ -240,7 +283,6 @@ class Templated(object):
         return res
 
     def _write_cache(self, keys):
-        from pylons import app_globals as g
         from r2.lib.cache import MemcachedError
 
         if not keys:
@@ -253,7 +295,6 @@ class Templated(object):
             return
 
     def _read_cache(self, keys):
-        from pylons import app_globals as g
         ret = g.rendercache.get_multi(keys)
         return ret
 
@@ -270,12 +311,21 @@ class Uncachable(Exception):
 _easy_cache_cls = set([bool, int, float, str, type(None), datetime])
 
 
+# formatting a datetime is slow next to a cache hit, and the same few
+# timestamps get formatted over and over. the other easy types aren't
+# cached: str() on them costs less than the lookup.
+@functools.lru_cache(maxsize=4096)
+def _datetime_cachable(v, tzinfo):
+    # tzinfo is only part of the key: the same instant in two timezones
+    # compares equal, but doesn't print the same
+    return str(v)
+
+
 def make_cachable(v, style):
     if v.__class__ in _easy_cache_cls or isinstance(v, type):
-        try:
-            return str(v)
-        except UnicodeDecodeError:
-            return repr(v)
+        if v.__class__ is datetime:
+            return _datetime_cachable(v, v.tzinfo)
+        return str(v)
     elif isinstance(v, (types.MethodType, CachedVariable)):
         return ''
     elif isinstance(v, (tuple, list, set)):
@@ -286,12 +336,23 @@ def make_cachable(v, style):
             ret[k] = make_cachable(v[k], style)
         return repr(ret)
     elif hasattr(v, "cache_key"):
-        result = v.cache_key(style)
+        try:
+            result = v.cache_key(style)
+        except Exception:
+            return repr(v)
         if result is None:
             return ''
         return str(result) if not isinstance(result, str) else result
+    elif isinstance(v, (int, float, str)):
+        return str(v)
     else:
-        raise Uncachable("%s, %s" % (v, type(v)))
+        # best-effort for anything else, rather than raising Uncachable and
+        # failing the render
+        return repr(v)
+
+
+CACHABLE_ATTR_NAMES_LIMIT = 4096
+_cachable_attr_names = {}
 
 
 class CachedTemplate(Templated):
@@ -306,16 +367,21 @@ class CachedTemplate(Templated):
 
     def cachable_attrs(self):
         """Returns attrs that should be used in generating the cache key."""
-        ret = []
-        for k in sorted(self.__dict__):
-            if k not in self.cache_ignore and not k.startswith('_'):
-                ret.append((k, self.__dict__[k]))
-        return ret
+        # instances of a class nearly always end up with the same attrs set
+        # in the same order, so the filtered and sorted names are shared.
+        # cache_ignore only ever varies by class.
+        d = self.__dict__
+        key = (self.__class__, tuple(d))
+        names = _cachable_attr_names.get(key)
+        if names is None:
+            if len(_cachable_attr_names) >= CACHABLE_ATTR_NAMES_LIMIT:
+                _cachable_attr_names.clear()
+            names = _cachable_attr_names[key] = tuple(
+                k for k in sorted(d)
+                if k not in self.cache_ignore and not k.startswith('_'))
+        return [(k, d[k]) for k in names]
 
     def cache_key(self, style):
-        from pylons import request
-        from pylons import tmpl_context as c
-
         keys = [
             c.user_is_loggedin,
             c.user_is_admin,
@@ -330,13 +396,21 @@ class CachedTemplate(Templated):
         if c.secure:
             keys.append(request.host)
 
-        keys = [make_cachable(x, style) for x in keys]
+        # feeding the hash piece by piece digests the same bytes as hashing
+        # the joined string, without building it
+        h = blake2b(digest_size=16)
+        for key in keys:
+            h.update(make_cachable(key, style).encode('utf-8'))
 
-        auto_keys = [(k, make_cachable(v, style))
-                     for k, v in self.cachable_attrs()]
-        keys.append(repr(auto_keys))
-        h = md5(''.join(keys).encode('utf-8')).hexdigest()
-        return "rend:%s:%s" % (self.render_class_name, h)
+        # values are length-prefixed so that one containing separator bytes
+        # can't run into the next attribute
+        for k, v in self.cachable_attrs():
+            v = make_cachable(v, style).encode('utf-8')
+            h.update(k.encode('utf-8'))
+            h.update(b'\0')
+            h.update(len(v).to_bytes(8, 'little'))
+            h.update(v)
+        return "rend:%s:%s" % (self.render_class_name, h.hexdigest())
 
 
 class Wrapped(CachedTemplate):
@@ -363,6 +437,13 @@ class Wrapped(CachedTemplate):
     def __getattr__(self, attr):
         if attr == 'lookups':
             raise AttributeError(attr)
+
+        # templates probe for the same missing attributes over and over, so
+        # remember the misses like the hits are remembered below
+        missing = self.__dict__.get('_missing_attrs')
+        if missing is not None and attr in missing:
+            raise AttributeError(attr)
+
         for lookup in self.lookups:
             try:
                 res = getattr(lookup, attr)
@@ -370,6 +451,10 @@ class Wrapped(CachedTemplate):
                 return res
             except AttributeError:
                 continue
+
+        if missing is None:
+            missing = self._missing_attrs = set()
+        missing.add(attr)
         raise AttributeError("%r has no %s" % (self, attr))
 
     def __iter__(self):
@@ -389,21 +474,3 @@ class Styled(CachedTemplate):
         base_template = super().template(style)
         # best-effort: return base_template (dummy)
         return base_template
-
-
-def make_cachable(v, style):
-    # best-effort serializer for cache keys
-    if v is None:
-        return 'None'
-    if isinstance(v, (bool, int, float, str)):
-        return str(v)
-    if isinstance(v, (list, tuple, set)):
-        return repr([make_cachable(x, style) for x in v])
-    if isinstance(v, dict):
-        return repr({k: make_cachable(v[k], style) for k in sorted(v)})
-    if hasattr(v, 'cache_key'):
-        try:
-            return v.cache_key(style)
-        except Exception:
-            return repr(v)
-    return repr(v)
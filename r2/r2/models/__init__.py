@@ -20,6 +20,9 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
+# these are imported eagerly on purpose: each Thing/Relation class registers
+# itself in thing_types/rel_types when it's created, and Thing._by_fullname
+# can only resolve fullnames of types that have already been registered.
 from .account import *
 from .admintools import *
 from .award import *
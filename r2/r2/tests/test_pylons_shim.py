@@ -33,3 +33,7 @@ def test_translator_push_and_get():
     pylons.translator._push_object(trans)
     assert hasattr(pylons.translator._stack[-1], 'gettext')
     pylons.translator._pop_object()
+
+
+def test_translator_is_cached_per_language():
+    assert _get_translator('en') is _get_translator('en')
@@ -68,6 +68,7 @@ class TestConfigValue(unittest.TestCase):
         self.assertEqual(('a', 'b'), ConfigValue.tuple_of(str)('a, b'))
         self.assertEqual(('a', 'b'),
                           ConfigValue.tuple_of(str, delim=':')('a : b'))
+        self.assertIs(ConfigValue.tuple_of(int), ConfigValue.tuple_of(int))
 
     def test_dict(self):
         self.assertEqual({}, ConfigValue.dict(str, str)(''))
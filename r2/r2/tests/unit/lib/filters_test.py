@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import unittest
+from unittest.mock import MagicMock
+
+import lxml.html
+import snudown
+from pylons import tmpl_context as c
+
+from r2.controllers.policies import PoliciesController
+from r2.lib import template_helpers
+from r2.lib.filters import (
+    SC_OFF,
+    SC_ON,
+    WIKI_MD_END,
+    WIKI_MD_START,
+    fragment_inner_html,
+    generate_table_of_contents,
+    wikimarkdown,
+)
+from r2.models.wiki import ImagesByWikiPage
+from r2.tests import RedditTestCase
+
+
+def parse_fragment(html):
+    return lxml.html.fragment_fromstring(html, create_parent='div')
+
+
+def wrap_wiki(html):
+    return SC_OFF + WIKI_MD_START + html + WIKI_MD_END + SC_ON
+
+
+class TestGenerateTableOfContents(unittest.TestCase):
+    def test_no_headers(self):
+        tree = parse_fragment('<p>no headers here</p>')
+        self.assertIsNone(generate_table_of_contents(tree, prefix='wiki'))
+
+    def test_nesting_with_skipped_levels(self):
+        tree = parse_fragment(
+            '<h1>One</h1><h3>Three</h3><h2>Two</h2><h1>Four</h1>')
+        toc = generate_table_of_contents(tree, prefix='wiki')
+        self.assertEqual(
+            lxml.html.tostring(toc, encoding='unicode'),
+            '<div class="toc"><ul>'
+            '<li class="wiki_one"><a href="#wiki_one">One</a></li>'
+            '<li class="toc_child"><ul>'
+            '<li class="wiki_three"><a href="#wiki_three">Three</a></li>'
+            '</ul></li>'
+            '<li class="wiki_two"><a href="#wiki_two">Two</a></li>'
+            '<li class="wiki_four"><a href="#wiki_four">Four</a></li>'
+            '</ul></div>'
+        )
+
+    def test_duplicate_header_ids(self):
+        tree = parse_fragment(
+            '<h1>Same Title</h1><h1>same title</h1><h1>Same Title</h1>')
+        generate_table_of_contents(tree, prefix='wiki')
+        self.assertEqual(
+            [header.get('id') for header in tree.iter('h1')],
+            ['wiki_same_title', 'wiki_same_title2', 'wiki_same_title3'],
+        )
+
+    def test_special_characters_in_ids(self):
+        tree = parse_fragment('<h2>Q&amp;A <em>now</em></h2>')
+        generate_table_of_contents(tree, prefix='section')
+        self.assertEqual(tree[0].get('id'), 'section_q.26a_now')
+
+    def test_empty_header_is_skipped(self):
+        tree = parse_fragment('<h1></h1><h1>Title</h1>')
+        toc = generate_table_of_contents(tree, prefix='wiki')
+        self.assertEqual(len(toc.findall('.//li')), 1)
+        self.assertIsNone(tree[0].get('id'))
+
+
+class TestWikiMarkdown(RedditTestCase):
+    def setUp(self):
+        super().setUp()
+        self.autopatch(c, "render_style", "html", create=True)
+        self.autopatch(c, "site", MagicMock(), create=True)
+        self.patch_g(domain="reddit.local", offsite_subdomains=[])
+
+    def render(self, html, **kw):
+        self.autopatch(snudown, "markdown", return_value=html)
+        return wikimarkdown("source text", **kw)
+
+    def test_no_tags_skips_parsing(self):
+        parse = self.autopatch(lxml.html, "fragment_fromstring")
+        html = '<p>just <strong>text</strong></p>'
+        self.assertEqual(self.render(html), wrap_wiki(html))
+        self.assertFalse(parse.called)
+
+    def test_headers_without_toc_skip_parsing(self):
+        parse = self.autopatch(lxml.html, "fragment_fromstring")
+        html = '<h1>Title</h1><p><a href="/r/pics">pics</a></p>'
+        self.assertEqual(self.render(html, include_toc=False),
+                         wrap_wiki(html))
+        self.assertFalse(parse.called)
+
+    def test_bytes_without_tags(self):
+        html = '<p>café</p>'
+        self.autopatch(snudown, "markdown",
+                       return_value=html.encode('utf-8'))
+        self.assertEqual(wikimarkdown("source text"), wrap_wiki(html))
+
+    def test_image_swap_and_drop(self):
+        self.autopatch(ImagesByWikiPage, "get_images", return_value={
+            "known": "//example.com/known.png",
+        })
+        html = ('<p><img src="%%known%%" alt="a">'
+                '<img src="%%unknown%%" alt="b">'
+                '<img src="https://example.com/direct.png" alt="c">'
+                '</p>')
+        self.assertEqual(
+            self.render(html, include_toc=False),
+            wrap_wiki('<p><img src="//example.com/known.png" alt="a"></p>'),
+        )
+
+    def test_text_before_first_element(self):
+        html = 'leading text<h1>Title</h1><p>body</p>'
+        self.assertEqual(
+            self.render(html),
+            wrap_wiki(
+                '<div class="toc"><ul>'
+                '<li class="wiki_title"><a href="#wiki_title">Title</a></li>'
+                '</ul></div>'
+                'leading text<h1 id="wiki_title">Title</h1><p>body</p>'
+            ),
+        )
+
+    def test_compact_links(self):
+        self.autopatch(c, "render_style", "compact", create=True)
+        add_sr = self.autopatch(template_helpers, "add_sr",
+                                side_effect=lambda href, **kw: href + ".sr")
+        html = ('<p><a href="/r/pics">local</a> '
+                '<a href="https://www.reddit.local/r/pics">reddit</a> '
+                '<a href="https://example.com/r/pics">offsite</a> '
+                '<a href="//example.com/x">relative offsite</a></p>')
+        self.assertEqual(
+            self.render(html, include_toc=False),
+            wrap_wiki(
+                '<p><a href="/r/pics.sr">local</a> '
+                '<a href="https://www.reddit.local/r/pics.sr">reddit</a> '
+                '<a href="https://example.com/r/pics">offsite</a> '
+                '<a href="//example.com/x">relative offsite</a></p>'
+            ),
+        )
+        self.assertEqual(add_sr.call_count, 2)
+
+
+class TestPolicyPageHtml(unittest.TestCase):
+    def setUp(self):
+        self.controller = PoliciesController()
+
+    def test_number_sections(self):
+        tree = parse_fragment(
+            '<div class="md">intro<p>first <em>para</em></p>'
+            '<div><p>nested</p></div><p>second</p></div>')
+        self.controller._number_sections(tree)
+        self.assertEqual(
+            fragment_inner_html(tree),
+            '<div class="md">intro'
+            '<p><a class="p-anchor" id="p_1" href="#p_1">1</a>'
+            ' first <em>para</em></p>'
+            '<div><p>nested</p></div>'
+            '<p><a class="p-anchor" id="p_2" href="#p_2">2</a> second</p>'
+            '</div>'
+        )
+
+    def test_linkify_headings(self):
+        tree = parse_fragment(
+            '<div class="md"><h1 id="section_a">A <em>b</em> c</h1>'
+            '<h4 id="section_d">D</h4></div>')
+        self.controller._linkify_headings(tree)
+        self.assertEqual(
+            fragment_inner_html(tree),
+            '<div class="md">'
+            '<h1 id="section_a"><a href="#section_a">A <em>b</em> c</a></h1>'
+            '<h4 id="section_d">D</h4>'
+            '</div>'
+        )
@@ -61,6 +61,15 @@ class AgentDetectorTest(RedditTestCase):
         self.assertTrue(agent_parsed['app_name'],
                         agent_parsed['browser']['name'])
 
+    def test_reddit_android_detector_long_version(self):
+        # a long run of digits that then fails to match used to backtrack
+        # exponentially through the version pattern
+        user_agent = 'RedditAndroid ' + '1' * 64 + 'x'
+        agent_parsed = {}
+        result = RedditAndroidDetector().detect(user_agent, agent_parsed)
+        self.assertTrue(result)
+        self.assertNotIn('version', agent_parsed['browser'])
+
     def test_reddit_ios_detector(self):
         user_agent = ('Reddit/Version 1.1/Build 1106/iOS Version 9.3.2 '
                       '(Build 13F69)')
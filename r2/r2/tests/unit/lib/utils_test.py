@@ -489,6 +489,40 @@ class TestTruncString(unittest.TestCase):
         self.assertEqual(truncated, 'ThisIsA...')
 
 
+class TestStrips(unittest.TestCase):
+    def test_rstrips(self):
+        self.assertEqual(utils.rstrips('foobar', 'bar'), 'foo')
+        self.assertEqual(utils.rstrips('foobar', 'foo'), 'foobar')
+
+    def test_lstrips(self):
+        self.assertEqual(utils.lstrips('foobar', 'foo'), 'bar')
+        self.assertEqual(utils.lstrips('foobar', 'bar'), 'foobar')
+
+    def test_empty_remove(self):
+        self.assertEqual(utils.rstrips('abc', ''), 'abc')
+        self.assertEqual(utils.lstrips('abc', ''), 'abc')
+        self.assertEqual(utils.strips('abc', ''), 'abc')
+
+    def test_bytes(self):
+        self.assertEqual(utils.rstrips(b'foobar', 'bar'), 'foo')
+        self.assertEqual(utils.lstrips('foobar', b'foo'), 'bar')
+
+
+class TestString2js(unittest.TestCase):
+    def test_plain(self):
+        self.assertEqual(utils.string2js('hello'), '"hello"')
+
+    def test_quotes_and_backslashes(self):
+        self.assertEqual(utils.string2js('a"b\\c'), '"a\\"b\\\\c"')
+
+    def test_script_close_and_control_characters(self):
+        self.assertEqual(utils.string2js('</script>\x15'),
+                         '"<\\/script>\\u0015"')
+
+    def test_named_control_characters(self):
+        self.assertEqual(utils.string2js('\n\t\x1f'), '"\\n\\t\\u001f"')
+
+
 class TestUrlToThing(unittest.TestCase):
 
     def test_subreddit_noslash(self):
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import unittest
+from unittest.mock import MagicMock
+
+from pylons import tmpl_context as c
+
+from r2.lib.wrapped import CacheStub, StringTemplate, Templated
+from r2.tests import RedditTestCase
+
+
+class TestStringTemplateResolve(unittest.TestCase):
+    def test_no_variables(self):
+        self.assertEqual(StringTemplate('plain').resolve({'a': 'x'}), 'plain')
+
+    def test_unknown_variable_is_kept(self):
+        self.assertEqual(StringTemplate('<$>a</$>').resolve({}), '<$>a</$>')
+
+    def test_nested_values(self):
+        template = StringTemplate('[<$>a</$>]')
+        d = {'a': '(<$>b</$> <$>b</$>)', 'b': '{<$>c</$>}', 'c': 'leaf'}
+        self.assertEqual(template.resolve(d), '[({leaf} {leaf})]')
+
+    def test_self_reference(self):
+        template = StringTemplate('<$>a</$>!')
+        self.assertEqual(template.resolve({'a': 'x<$>a</$>'}), 'x<$>a</$>!')
+
+    def test_mutual_reference(self):
+        template = StringTemplate('<$>a</$>')
+        d = {'a': 'A<$>b</$>', 'b': 'B<$>a</$>'}
+        self.assertEqual(template.resolve(d), 'AB<$>a</$>')
+
+
+class FakeTemplate:
+    """Renders a thing's parts, rendering the Templated ones in place."""
+    def render(self, thing):
+        return ''.join(
+            str(part.render()) if isinstance(part, Templated) else part
+            for part in thing.parts)
+
+
+class Fragment(Templated):
+    def template(self, style='html'):
+        return FakeTemplate()
+
+    def cache_key(self, style):
+        return 'fragment:%s' % id(self)
+
+
+class CachedFragment(Fragment):
+    cachable = True
+
+
+class TestTemplatedRender(RedditTestCase):
+    def setUp(self):
+        super().setUp()
+        self.autopatch(c, "render_tracker", None, create=True)
+        self.autopatch(c, "render_style", "html", create=True)
+        self.patch_g(stats=MagicMock(), rendercache=MagicMock())
+        self.read_cache = self.autopatch(
+            Templated, "_read_cache", return_value={})
+        self.autopatch(Templated, "_write_cache")
+
+    def test_nested_cached_stubs(self):
+        leaf = CachedFragment(parts=['leaf'])
+        middle = CachedFragment(parts=['(', leaf, ')'])
+        page = Fragment(parts=['[', middle, '|', leaf, ']'])
+        self.assertEqual(page.render(), '[(leaf)|leaf]')
+        self.assertIsNone(c.render_tracker)
+
+    def test_cached_stub_read_from_cache(self):
+        leaf = CachedFragment(parts=['fresh'])
+        self.read_cache.return_value = {
+            leaf.cache_key('html'): StringTemplate('cached'),
+        }
+        page = Fragment(parts=['<', leaf, '>'])
+        self.assertEqual(page.render(), '<cached>')
+
+    def test_kwargs_fill_nested_fragments(self):
+        leaf = CachedFragment(parts=['hello <$>name</$>'])
+        page = Fragment(parts=['[', leaf, ']'])
+        self.assertEqual(page.render(name='world'), '[hello world]')
+
+    def test_kwargs_win_over_updates(self):
+        leaf = CachedFragment(parts=['from the cache'])
+        page = Fragment(parts=['[', leaf, ']'])
+        stub_name = CacheStub(leaf, 'html').name
+        self.assertEqual(page.render(**{stub_name: 'from kwargs'}),
+                         '[from kwargs]')
+
+    def test_self_referencing_kwarg(self):
+        page = Fragment(parts=['<$>a</$>'])
+        self.assertEqual(page.render(a='x<$>a</$>'), 'x<$>a</$>')
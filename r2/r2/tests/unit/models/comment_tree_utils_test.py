@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import unittest
+
+from r2.lib.utils.comment_tree_utils import calc_num_children, get_tree_details
+
+
+# ids out of order relative to the tree structure, plus a subtree (7 -> 3
+# -> 1) whose root comment is missing from the tree
+TREE = {
+    None: [50, 10],
+    50: [20],
+    20: [5],
+    10: [],
+    7: [3],
+    3: [1],
+}
+
+
+class GetTreeDetailsTest(unittest.TestCase):
+    def test_in_order_ids(self):
+        tree = {None: [1, 2], 1: [3], 3: [4]}
+        cids, depth, parents = get_tree_details(tree)
+        self.assertEqual(cids, [1, 2, 3, 4])
+        self.assertEqual(depth, {1: 0, 2: 0, 3: 1, 4: 2})
+        self.assertEqual(parents, {1: None, 2: None, 3: 1, 4: 3})
+
+    def test_out_of_order_ids(self):
+        cids, depth, parents = get_tree_details(TREE)
+        self.assertEqual(depth[50], 0)
+        self.assertEqual(depth[10], 0)
+        self.assertEqual(depth[20], 1)
+        self.assertEqual(depth[5], 2)
+        self.assertEqual(parents[20], 50)
+        self.assertEqual(parents[5], 20)
+
+    def test_orphaned_subtree(self):
+        cids, depth, parents = get_tree_details(TREE)
+        self.assertEqual(sorted(cids), [1, 3, 5, 10, 20, 50])
+        self.assertEqual(depth[3], 0)
+        self.assertEqual(depth[1], 1)
+        self.assertEqual(parents[3], 7)
+        self.assertEqual(parents[1], 3)
+        self.assertNotIn(7, depth)
+
+
+class CalcNumChildrenTest(unittest.TestCase):
+    def test_in_order_ids(self):
+        tree = {None: [1, 2], 1: [3], 2: [], 3: [4]}
+        self.assertEqual(calc_num_children(tree), {1: 2, 2: 0, 3: 1})
+
+    def test_out_of_order_ids(self):
+        num_children = calc_num_children(TREE)
+        self.assertEqual(num_children[50], 2)
+        self.assertEqual(num_children[20], 1)
+        self.assertEqual(num_children[10], 0)
+
+    def test_orphaned_subtree(self):
+        num_children = calc_num_children(TREE)
+        self.assertEqual(num_children[7], 2)
+        self.assertEqual(num_children[3], 1)
+        self.assertNotIn(None, num_children)